@@ -1,19 +1,41 @@
-# Import packages
-from psychopy import core, event, gui, visual, parallel
+# Import packages (psychopy is imported in the background while the participant ID is typed, see NEE1_startup.py)
 import time
-import math
-import random
-import csv
 import os
-
-ports_live = True # Set to None if parallel ports not plugged for coding/debugging other parts of exp
+import sys
+from NEE1_timing import PulseTimeline, PulseEngine, TimingStats, FlipRecorder, sleep_until, default_clock
+from NEE1_data import TrialWriter, SessionJournal, load_journal
+from NEE1_columns import column_schema, text_width, write_session
+from NEE1_records import Trial, TrialStore, data_columns
+from NEE1_collector import CollectorClient
+from NEE1_telemetry import TelemetryPublisher
+from NEE1_eventlog import EventLog
+from NEE1_port import open_port, RecordingPort, PortState
+from NEE1_stimuli import TextStimCache
+from NEE1_startup import AssetPreloader, StartupTimer
+from NEE1_input import ResponseEngine
+from NEE1_trial import TrialPhase, run_phases, countdown_numbers
+from NEE1_critical import CriticalSections
+from NEE1_watchdog import EscapeWatcher, StallWatchdog, windows_key_down, window_handle
+from NEE1_schedule import TENS_names, ScheduleConstraints, session_plan, load_plan, plan_mismatches, plan_path
+
+startup = StartupTimer() # time to first frame is printed and saved in the journal
+
+ports_live = True # Set to None if parallel ports not plugged for coding/debugging other parts of exp, or "record" to log every port write to data/<PID>_port.csv
+port_address = 0x3ff8 #Get from device Manager
 
 ### Experiment details/parameters
 # misc parameters
 port_buffer_duration = 1 #needs about 0.5s buffer for port signal to reset 
+max_on_time = {"TENS": 0.25, "shock": port_buffer_duration + 0.25} # longest each port field may stay on before the stall watchdog clears the port
+heartbeat_timeout = 0.25 # longest the main loop may go without an escape check (every frame) while anything is on the port
 iti = 3
+wait_spin_time = 0.002 # wait() sleeps until this close to the end and then spins (tune per machine with: python NEE1_timing.py overshoot)
+escape_check_interval = 0.02 # how often wait() checks whether escape was pressed while sleeping (the port is zeroed straight away by the escape watcher)
 pain_response_duration = float("inf")
 response_hold_duration = 1 # How long the rating screen is left on the response (only used for Pain ratings)
+countdown_duration = 10 # seconds from the start of the countdown to the shock
+TENS_on_time = 8 # seconds left on the countdown when TENS comes on
+expectancy_time = 7 # seconds left on the countdown when the expectancy rating is asked
 TENS_trig = 128
 TENS_pulse_pattern_list = {"pause": [(0.0, TENS_trig), (0.1, 0), # 3 rapid pulses followed by pause, first number specifies time in seconds, second number port send value
                                  (0.2, TENS_trig), (0.3, 0),
@@ -27,8 +49,17 @@ TENS_image_pos = (0,200)
 TENS_text_pos = (0,300)
 
 timer_precision_range = 0.01 # pulses should be accurate to within 10 milliseconds
+flip_timing = False # Set to True to record every flip in show_trial and save per-trial frame timing to data/<PID>_frames.csv
+event_logging = True # Set to False to stop logging every flip, port write, response and escape check to data/<PID>_events.bin (see NEE1_eventlog.py)
+columnar_output = False # Set to True to also save the trial data as typed binary columns in data/<PID>_columns (see NEE1_columns.py)
+TENS_pulse_period = 1 # pulse patterns repeat every second while TENS is on
+
+collector_address = None # "host:port" of a trial collector (python NEE1_collector.py serve) to also send every trial to and check participant IDs with across stations
+station_name = None # name this station gives the collector (defaults to the computer name)
+telemetry_address = "127.0.0.1:8766" # where live trial events are sent for the experimenter console (python NEE1_telemetry.py view), or None
 
-TENS_names = ["monopolar", "bipolar"]
+schedule_seed = 0 # seed for trial orders built at startup when a PID has no plan file (see NEE1_schedule.py)
+schedule_max_run = None # most trials of one type in a row, or None for the plain within-block shuffle (a protocol decision: a limit changes the randomisation; recorded in the plan)
 
 # interval length for TENS on/off signals (e.g. 0.1 = 0.2s per pulse)
 
@@ -36,23 +67,37 @@ TENS_names = ["monopolar", "bipolar"]
 P_info = {"PID": ""}
 info_order = ["PID"]
 
+script_directory = os.path.dirname(os.path.abspath(__file__))  #Set the working directory to the folder the Python code is opened from
+
+#set a path to a "data" folder to save data in
+data_folder = os.path.join(script_directory, "data")
+
+#set stimuli folder path
+stimulus_folder =  os.path.join(script_directory, "stimuli")
+
+# import psychopy and decode the TENS images while the experimenter types the participant ID
+preload = AssetPreloader(["psychopy.core", "psychopy.event", "psychopy.gui", "psychopy.visual", "psychopy.hardware.keyboard"],
+                         {"pause": os.path.join(stimulus_folder, "pause.png"),
+                          "constant": os.path.join(stimulus_folder, "constant.png")}).start()
+
+# stream trials to the collector, if there is one (spooled in the data folder while it can't be reached)
+collector = None
+if collector_address != None:
+    collector = CollectorClient(collector_address, data_folder, station_name).start()
+
 # Participant info input
+resume_state = None # journal of an interrupted session to continue, if the experimenter chooses to
 while True:
     try:
         P_info["PID"] = input("Enter participant ID: ")
         if not P_info["PID"]:
             print("Participant ID cannot be empty.")
             continue
+        if columnar_output and len(P_info["PID"]) > text_width(column_schema["PID"]):
+            print(f"Participant ID can be at most {text_width(column_schema['PID'])} characters long with columnar_output on.")
+            continue
             
         csv_filename = P_info["PID"] + "_responses.csv"
-        script_directory = os.path.dirname(os.path.abspath(__file__))  #Set the working directory to the folder the Python code is opened from
-        
-        #set a path to a "data" folder to save data in
-        data_folder = os.path.join(script_directory, "data")
-
-        #set stimuli folder path
-
-        stimulus_folder =  os.path.join(script_directory, "stimuli")
         
         # if data folder doesn"t exist, create one
         if not os.path.exists(data_folder):
@@ -60,73 +105,90 @@ while True:
         
         #set file name within "data" folder
         csv_filepath = os.path.join(data_folder,csv_filename)
+        journal_filepath = os.path.join(data_folder, P_info["PID"] + "_journal.jsonl")
+        
+        # offer to resume an interrupted session from its journal instead of starting over
+        resume_state = None
+        if os.path.exists(journal_filepath):
+            journal_state = load_journal(journal_filepath)
+            if not journal_state["finished"] and journal_state["trial_order"] != None:
+                print(f"Session for participant {P_info['PID']} was interrupted after {len(journal_state['completed'])} of {len(journal_state['trial_order'])} trials.")
+                if input("Resume this session? (y/n): ").strip().lower() == "y":
+                    resume_state = journal_state
         
-        if os.path.exists(csv_filepath):
+        if resume_state == None and (os.path.exists(csv_filepath) or os.path.exists(csv_filepath + ".partial") or os.path.exists(journal_filepath)):
             print(f"Data for participant {P_info['PID']} already exists. Choose a different participant ID.") ### to avoid re-writing existing data
             
         else:
-            cb = int(P_info["PID"]) % 4
-
-            if cb in [0, 2]:
-                group = 1
-                group_name = "consistent"
-            else:
-                group = 2
-                group_name = "change"
-
-            cb = int(P_info["PID"]) % 4
-            
+            # the collector knows the participant IDs used at every station
+            if collector != None:
+                claimed = collector.claim(P_info["PID"], resume=resume_state != None)
+                if claimed == False:
+                    print(f"Participant ID {P_info['PID']} is already in use at {collector.owner}. Choose a different participant ID.")
+                    continue
+                if claimed == None:
+                    print("The trial collector can't be reached, so the participant ID was only checked on this computer.")
             break  # Exit the loop if the participant ID is valid
     except KeyboardInterrupt:
         print("Participant info input canceled.")
         break  # Exit the loop if the participant info input is canceled
+startup.mark("PID")
 
-    # get date and time of experiment start
-datetime = time.strftime("%Y-%m-%d_%H.%M.%S")
+# usually finished long before the ID is entered
+preload.wait()
+from psychopy import core, event, gui, visual
+from psychopy.hardware import keyboard
 
-TENS_trialtypes = {"suboptimal": TENS_names[cb%2],
-                 "optimal" : TENS_names[(cb+1)%2]
-}
-
-if (cb // 2) % 2 == 0:
-    TENS1_name = TENS_trialtypes["suboptimal"] #e.g. monopolar
-    TENS2_name = TENS_trialtypes["optimal"] #e.g. bipolar
-    TENS1_type = "suboptimal"
-    TENS2_type = "optimal"
+    # get date and time of experiment start (kept from the original start when resuming)
+if resume_state != None:
+    datetime = resume_state["session"]["datetime"]
 else:
-    TENS1_name = TENS_trialtypes["optimal"]
-    TENS2_name = TENS_trialtypes["suboptimal"]
-    TENS1_type = "optimal"
-    TENS2_type = "suboptimal"
-
+    datetime = time.strftime("%Y-%m-%d_%H.%M.%S")
+
+# Load the participant's session plan: counterbalancing, trial orders and pre-drawn outcomes, built offline with
+# "python NEE1_schedule.py plans <first PID> <last PID>" so it can be checked before the session.
+# Without a plan file the same plan is built now from schedule_seed. A plan file made for another PID, seed or
+# schedule_max_run is refused.
+plan_folder = os.path.join(script_directory, "plans")
+plan_filepath = plan_path(plan_folder, P_info["PID"])
+if os.path.exists(plan_filepath):
+    plan = load_plan(plan_filepath)
+    mismatches = plan_mismatches(plan, P_info["PID"], schedule_seed, ScheduleConstraints(schedule_max_run))
+    if mismatches:
+        sys.exit(f"{plan_filepath} was not made for this session: {'; '.join(mismatches)}. Regenerate it with "
+                 f"NEE1_schedule.py plans, or check schedule_seed and schedule_max_run.")
+else:
+    plan = session_plan(P_info["PID"], schedule_seed, ScheduleConstraints(schedule_max_run))
 
-# Assign pulse pattern lists
-TENS_pulse_patterns = {
-    TENS1_name: TENS_pulse_pattern_list["pause"],
-    TENS2_name: TENS_pulse_pattern_list["constant"]
-}
+cb = plan["cb"]
+group = plan["group"]
+group_name = plan["group_name"]
+TENS_trialtypes = plan["TENS_trialtypes"]
+TENS1_name = plan["TENS1_name"] #e.g. monopolar
+TENS2_name = plan["TENS2_name"] #e.g. bipolar
+TENS1_type = plan["TENS1_type"] #e.g. suboptimal
+TENS2_type = plan["TENS2_type"]
 
 # Store pulse pattern names for saving
-TENS_pulse_patterns_names = {
-    TENS1_type: "pause",
-    TENS2_type: "constant"
-}
+TENS_pulse_patterns_names = plan["TENS_pulse_patterns_names"]
 
-# external equipment connected via parallel ports
-shock_levels = 10
+# Assign pulse pattern lists
+TENS_pulse_patterns = {TENS_trialtypes[TENS_type]: TENS_pulse_pattern_list[pattern]
+                       for TENS_type, pattern in TENS_pulse_patterns_names.items()}
 
+# external equipment connected via parallel ports
 shock_trig = {"high": 1, 
               "low": 11, 
               "medium": 21} #byte values start on lowest levels
 
 stim_trig = {"TENS": 128, "control": 0} #Pin 8 TENS in AD instrument
 
-if ports_live == True:
-    pport = parallel.ParallelPort(address=0x3ff8) #Get from device Manager
-    pport.setData(0)
-    
-elif ports_live == None:
-    pport = None #Get from device Manager
+pport = open_port(ports_live, port_address) # hardware, recording or no-op port (see NEE1_port.py)
+port_state = PortState(pport, {"TENS": TENS_trig, "shock": 0x7F}) # TENS on pin 8, shock level on pins 1-7
+telemetry = TelemetryPublisher(telemetry_address).start() if telemetry_address != None else None
+if telemetry != None:
+    port_state.listeners.append(telemetry.port_listener)
+port_state.clear()
 
 # set up screen
 win = visual.Window(
@@ -135,6 +197,31 @@ win = visual.Window(
     monitor="testMonitor", color=[0, 0, 0], colorSpace="rgb1",
     blendMode="avg", useFBO=True,
     units="pix")
+startup.mark("window")
+
+# mouse clicks and key presses with response times from the onset flip of each response screen (see NEE1_input.py)
+responses = ResponseEngine(win, event.Mouse(win=win), keyboard.Keyboard())
+
+# escape is watched on its own thread, which zeroes the port as soon as the key goes down while the experiment window
+# has focus (see NEE1_watchdog.py). Without the window handle, escape is read from the response keyboard instead: on its
+# own thread with the psychtoolbox backend, otherwise each time the main loop checks (every frame and during waits).
+if sys.platform == "win32" and window_handle(win) != None:
+    escape_watcher = EscapeWatcher(windows_key_down(window_handle(win)), port_state.shutdown, source="GetAsyncKeyState").start()
+else:
+    if sys.platform == "win32":
+        print("Warning: the experiment window's handle is not available, so escape is read from the psychopy keyboard "
+              "and the port may be zeroed later after it is pressed.")
+    escape_watcher = EscapeWatcher(responses.escape_down, port_state.shutdown, threaded=getattr(keyboard, "havePTB", False),
+                                   source="psychopy keyboard").start()
+
+# screen texts are built once and reused from this cache (warmed up with every instruction and response text below)
+text_cache = TextStimCache(win, visual.TextStim)
+text_styles = {"instructions": {"height": 35, "pos": (0,0), "wrapWidth": 960},
+               "continue": {"height": 35, "pos": (0,-400)},
+               "prompt": {"height": 35, "pos": (0,0), "wrapWidth": 800},
+               "message": {"height": 35, "pos": (0,0)},
+               "button_right": {"height": 25, "pos": (400, -300), "wrapWidth": 300},
+               "button_left": {"height": 25, "pos": (-400, -300), "wrapWidth": 300}}
 
 # fixation stimulus
 fix_stim = visual.TextStim(win,
@@ -145,12 +232,12 @@ fix_stim = visual.TextStim(win,
 
 #load in TENS graphics
 TENS_pulse_pattern_image_list = {"pause": visual.ImageStim(win,
-                                    image=os.path.join(stimulus_folder, "pause.png"),
+                                    image=preload.images["pause"],
                                     size = TENS_image_size,
                                     pos = TENS_image_pos
                                     ),
                             "constant": visual.ImageStim(win,
-                                    image=os.path.join(stimulus_folder, "constant.png"),
+                                    image=preload.images["constant"],
                                     size = TENS_image_size,
                                     pos = TENS_image_pos
                             )
@@ -177,232 +264,165 @@ TENS_pulse_pattern_text = {
                     ),
     }
 
+# flip the window, recording the flip time for the trial phase when flip_timing is on
+flip_log = FlipRecorder() if flip_timing else None
+
+def flip(phase):
+    flip_time = win.flip()
+    log_event("flip", FlipRecorder.phases.get(phase, -1))
+    if flip_log != None:
+        flip_log.record(flip_time, phase)
+    return flip_time
+
+def log_event(name, value=0): # binary event log (see NEE1_eventlog.py)
+    if event_log != None:
+        event_log.log(name, value)
+
 #define waiting function so experiment doesn't freeze as it does with core.wait()
+# sleeps most of the time and only spins for the last wait_spin_time, checking for escape every escape_check_interval
+wait_overshoot = TimingStats()
+
 def wait(time):
-    countdown_timer = core.CountdownTimer(time)
-    while countdown_timer.getTime() > 0:
-        termination_check()
+    wait_overshoot.add(sleep_until(default_clock.now() + time,
+                                   spin_time=wait_spin_time,
+                                   check=termination_check,
+                                   check_interval=escape_check_interval))
+
+def iti_wait(): # ITI after a trial, starting with the garbage collection deferred by its critical section
+    iti_end = default_clock.now() + iti
+    critical.collect()
+    wait(iti_end - default_clock.now())
         
 #create instruction trials
 def instruction_trial(instructions,holdtime): 
     termination_check()
-    visual.TextStim(win,
-                    text = instructions,
-                    height = 35,
-                    color = "white",
-                    pos = (0,0),
-                    wrapWidth= 960
-                    ).draw()
+    instructions_stim = text_cache.get(instructions, **text_styles["instructions"])
+    instructions_stim.draw()
     win.flip()
     wait(holdtime)
-    visual.TextStim(win,
-                    text = instructions,
-                    height = 35,
-                    color = "white",
-                    pos = (0,0),
-                    wrapWidth= 960
-                    ).draw()
-    visual.TextStim(win,
-                    text = instructions_text["continue"],
-                    height = 35,
-                    color = "white",
-                    pos = (0,-400)
-                    ).draw()
-    win.flip()
-    event.waitKeys(keyList=["space"])
+    screen = [instructions_stim, text_cache.get(instructions_text["continue"], **text_styles["continue"])]
+    responses.onset()
+    responses.redraw(screen)
+    responses.wait_keys(["space"], screen, check=termination_check)
     win.flip()
     
     wait(iti)
     
 # Create functions
-    # Save responses to a CSV file
-def save_data(data):
-    trial_order.extend(calib_trial_order)
-    
-    for trial in trial_order:
-        trial['datetime'] = datetime
-        trial["PID"] = P_info["PID"]
-        trial["group"] = group
-        trial["group_name"] = group_name
-        trial["cb"] = cb
-        trial["optimalTENS_name"] = TENS_trialtypes["optimal"]
-        trial["optimalTENS_pattern"] = TENS_pulse_patterns_names["optimal"]
-        trial["shock_level_high"] = shock_trig["high"]
-
-
-    # Extract column names from the keys in the first trial dictionary
-    colnames = list(trial_order[0].keys())
-
-    # Open the CSV file for writing
-    with open(csv_filepath, mode="w", newline="") as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=colnames)
-        
-        # Write the header row
-        writer.writeheader()
-        
-        # Write each trial"s data to the CSV file
-        for trial in data:
-            writer.writerow(trial)
+    # Save responses to a CSV file, one row per trial as it completes
+def session_info(): # fields that are the same for every trial in the session (stored once, see NEE1_records.py)
+    return {"datetime": datetime,
+            "PID": P_info["PID"],
+            "group": group,
+            "group_name": group_name,
+            "cb": cb,
+            "optimalTENS_name": TENS_trialtypes["optimal"],
+            "optimalTENS_pattern": TENS_pulse_patterns_names["optimal"]}
+
+def publish(kind, **fields): # live event for the experimenter console
+    if telemetry != None:
+        telemetry.publish(kind, **fields)
+
+def save_trial(trial):
+    trial["shock_level_high"] = shock_trig["high"] # changes during calibration
+    row = trial_store.append(trial) # data file row, with the session constants
+    publish("trial", **trial)
+    journal.record("trial", trial=trial.as_dict())
+    data_writer.writerow(row) # flushed to disk by sync_data() before each ITI
+    if collector != None: # numbered by position in the session, so resending is harmless
+        collector.send(P_info["PID"], len(trial_store) - 1, dict(zip(data_columns, row)))
+
+def sync_data(): # journal first, so the data file can always be rebuilt from it
+    journal.sync()
+    data_writer.sync()
+
+def save_data(): # move the completed data file into place at the end of the session (or on escape)
+    data_writer.finalize()
+    if isinstance(pport, RecordingPort):
+        pport.save(os.path.join(data_folder, P_info["PID"] + "_port.csv"))
+    if flip_log != None:
+        flip_log.write_summary(os.path.join(data_folder, P_info["PID"] + "_frames.csv"), win.monitorFramePeriod)
+    if columnar_output:
+        write_session(os.path.join(data_folder, P_info["PID"] + "_columns"), trial_store.columns(), P_info["PID"])
+    if collector != None:
+        unsent = collector.close()
+        if unsent:
+            print(f"{unsent} trials were not acknowledged by the collector; they are spooled in the data folder and resent next time.")
+    if telemetry != None:
+        telemetry.close()
+    if event_log != None:
+        event_log.close()
+    escape_watcher.stop()
+    stall_watchdog.stop()
+    critical.close()
     
 def exit_screen(instructions):
     win.flip()
-    visual.TextStim(win,
-            text = instructions,
-            height = 35,
-            color = "white",
-            pos = (0,0)).draw()
-    win.flip()
-    event.waitKeys()
+    screen = [text_cache.get(instructions, **text_styles["message"])]
+    responses.onset()
+    responses.redraw(screen)
+    responses.wait_keys(stims=screen)
     win.close()
     
-def termination_check(): #insert throughout experiment so participants can end at any point.
-    keys_pressed = event.getKeys(keyList=["escape"])  # Check for "escape" key during countdown
-    if "escape" in keys_pressed:
-        if ports_live:
-            pport.setData(0) # Set all pins to 0 to shut off TENS, shock etc.
+def termination_check(): #insert throughout experiment so participants can end at any point (only checks a flag, so it can run every frame)
+    stall_watchdog.beat()
+    if escape_watcher.pending(): # the watcher has already zeroed the port
+        escape_watcher.handle()
+        log_event("escape_check", 1)
+        publish("escape")
+        if pulse_engine != None:
+            pulse_engine.stop() # stop TENS pulses before the port is cleared
+        port_state.clear() # Set all pins to 0 to shut off TENS, shock etc.
+        escape_report = escape_watcher.report()
+        print(f"Escape: port zeroed {escape_report['detect_to_zero'] * 1000:.2f} ms and exit started {escape_report['detect_to_exit'] * 1000:.1f} ms after the key was seen")
+        journal.record("escape", **escape_report)
+        journal.sync()
         # Save participant information
 
-        save_data(trial_order)
+        save_data()
         exit_screen(instructions_text["termination"])
         core.quit()
         
-#define choice function for TENS trials
-
-def outcome_randomise(outcome1,outcome2,rft_schedule):
-    return random.choices(
-        [outcome1,outcome2],
-        weights = [rft_schedule,1-rft_schedule],
-    k=1
-    )[0]
-
-# Define trials
-# Calibration trials
-calib_trial_order = []
-for i in range(1,shock_levels+1):
-    temp_trial_order = []
-    trial = {
-        "phase": "calibration",
-        "blocknum": "calibration",
-        "stimulus": None,
-        "choicetrial": False,
-        "choice1": None,
-        "choice2": None,
-        "outcome" : "high",
-        "trialtype": "calibration",
-        "pain_response": None
-        } 
-    temp_trial_order.append(trial)
-    calib_trial_order.extend(temp_trial_order)
-    
-
-# Setting conditioning trial order
-# Number of trials
-trial_order = []
-
-#### 4 x blocks (2 TENS + low shock, 2 control + high shock)
-num_blocks_conditioning = 10
-num_blocks_extinction = 10
-num_trials_block = {
-        "conditioning": {
-            "TENS": {
-                "num":4,
-                "stimulus": "TENS",
-                "choicetrial": True,
-                "choice1": TENS_trialtypes["optimal"],
-                "choice2": TENS_trialtypes["suboptimal"],
-                "outcome": None,
-                "trialtype": None
-            },
-            "control": {
-                "num":1,
-                "stimulus": None, 
-                "choicetrial": False,
-                "choice1": None,
-                "choice2": None,
-                "outcome": "low",
-                "trialtype": "control"
-            }
-        },
-        "extinction": {
-            "monopolar": {
-                "num":1,
-                "stimulus": "TENS",
-                "choicetrial": False,
-                "choice1": None,
-                "choice2": None,
-                "outcome": "low",
-                "trialtype": "monopolar"
-            },
-            "bipolar": {
-                "num":1,
-                "stimulus": "TENS",
-                "choicetrial": False,
-                "choice1": None,
-                "choice2": None,
-                "outcome": "low",
-                "trialtype": "bipolar"
-            },
-            "control": {
-                "num":1,
-                "stimulus": None,
-                "choicetrial": False,
-                "choice1": None,
-                "choice2": None,
-                "outcome": "low",
-                "trialtype": "control"
-            }
-        }
-}
-
-if group_name == "consistent":
-    rft_schedule_blocks = {
-        "conditioning": [1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
-        "extinction": [1] * num_blocks_extinction
-    }
+# Define trials (from the session plan)
+calib_trial_order = [Trial(**trial) for trial in plan["calib_trial_order"]]
+trial_order = [Trial(**trial) for trial in plan["trial_order"]]
+
+# When resuming, continue the journalled trial order with the calibrated shock levels
+if resume_state != None:
+    trial_order = [Trial.from_row(trial) for trial in resume_state["trial_order"]]
+    if resume_state["shock_trig"] != None:
+        shock_trig.update(resume_state["shock_trig"])
+    if os.path.exists(csv_filepath + ".partial"): # rebuilt from the journal below
+        os.remove(csv_filepath + ".partial")
+
+# Open the data file now so every trial is written as soon as it finishes (one fixed set of columns for every trial)
+data_writer = TrialWriter(csv_filepath, data_columns)
+
+journal = SessionJournal(journal_filepath)
+trial_store = TrialStore(session_info()) # every saved trial, for the columnar copy
+if resume_state != None:
+    for row in resume_state["rows"]:
+        data_writer.writerow(trial_store.append(Trial.from_row(row)))
+    journal.record("resumed", time=time.strftime("%Y-%m-%d_%H.%M.%S"))
 else:
-    rft_schedule_blocks = {
-        "conditioning": [1, 1, 0.75, 0.75, 0.5, 0.5, 0.25, 0.25, 0, 0],
-        "extinction": [1] * num_blocks_extinction
-    }
-    
-for phase, trials in num_trials_block.items():
-    if phase == "conditioning":
-        num_blocks = num_blocks_conditioning 
-    else: 
-        num_blocks = num_blocks_extinction
-    
-    for block in range(num_blocks):
-        temp_trial_order = []
-
-        for trial_type, trial_info in trials.items():
-            for num in range(trial_info["num"]):
-                trial = {
-                    "phase": phase,
-                    "trialtype": trial_info["trialtype"],
-                    "stimulus": trial_info["stimulus"],
-                    "choice1": trial_info["choice1"],
-                    "choice2": trial_info["choice2"],
-                    "choicetrial": trial_info["choicetrial"],
-                    "rft_schedule": rft_schedule_blocks[phase][block],
-                    "outcome": trial_info["outcome"],
-                    "choice_response": None,
-                    "choice_optimal": None,
-                    "exp_response": None,
-                    "pain_response": None
-                }
-                if phase == "conditioning":
-                    trial["blocknum"] = (block//2) + 1
-                else:
-                    trial["blocknum"] = block
-                    
-                temp_trial_order.append(trial)
-
-        random.shuffle(temp_trial_order)
-        trial_order.extend(temp_trial_order)
-    
-# Assign trial numbers
-for trialnum, trial in enumerate(trial_order, start=1):
-    trial["trialnum"] = trialnum
+    journal.record("session", PID=P_info["PID"], datetime=datetime)
+    journal.record("trial_order", trial_order=[trial.as_dict() for trial in trial_order])
+journal.record("escape_watcher", source=escape_watcher.source, threaded=escape_watcher.threaded,
+               poll_interval=escape_watcher.poll_interval)
+sync_data()
+
+# log of flips, port writes and responses, appended to when a session is resumed
+event_log = None
+if event_logging:
+    event_log = EventLog(os.path.join(data_folder, P_info["PID"] + "_events.bin")).start()
+    port_state.listeners.append(event_log.writer("port"))
+    responses.listeners.append(event_log.log)
+log_event("session", 2 if resume_state != None else 1)
+
+# clears the port if a field stays on too long, or the main loop stops beating while anything is on (see NEE1_watchdog.py)
+stall_watchdog = StallWatchdog(port_state, max_on_time, heartbeat_timeout,
+                               incident_path=os.path.join(data_folder, P_info["PID"] + "_incidents.csv")).start()
+publish("session", PID=P_info["PID"], group_name=group_name, cb=cb, trials=len(trial_order), resumed=resume_state != None)
     
 #Test questions
 rating_stim = { "Calibration": visual.Slider(win,
@@ -469,7 +489,8 @@ As you are waiting for the shock during the countdown, you will also be asked to
 Please ask the experimenter if you have any questions now before proceeding.",
     "continue" : "\n\nPress spacebar to continue",
     "end" : "This concludes the experiment. Please ask the experimenter to help remove the devices.",
-    "termination" : "The experiment has been terminated. Please ask the experimenter to help remove the devices."
+    "termination" : "The experiment has been terminated. Please ask the experimenter to help remove the devices.",
+    "resume" : "Welcome back. The experiment will now continue from where it stopped."
 }
 
 cue_demo_text = "When you are completely relaxed, press any key to start the next block..."
@@ -486,6 +507,16 @@ response_instructions = {
     "Choice": "Please choose which frequency of TENS you want to receive on this trial."
                          }
 
+# build and upload every screen text now rather than right before the screen is shown
+text_cache.warm([(instructions_text[name], text_styles["instructions"])
+                 for name in ["welcome", "TENS_introduction", "calibration", "calibration_finish", "experiment", "resume"]]
+                + [(instructions_text["continue"], text_styles["continue"]),
+                   (instructions_text["end"], text_styles["message"]),
+                   (instructions_text["termination"], text_styles["message"])]
+                + [(response_instructions[name], text_styles["prompt"]) for name in ["Shock", "Shock_check"]]
+                + [(response_instructions[name], text_styles["message"]) for name in ["Check", "Check_lvl1", "Check_max", "Choice"]]
+                + [(TENS1_name, text_styles["button_right"]), (TENS2_name, text_styles["button_left"])])
+
 pain_text = visual.TextStim(win,
             text=response_instructions["Pain"],
             height = 35,
@@ -528,21 +559,9 @@ button_text = {
                             pos=(-400, -300),
                             wrapWidth=300),
         },
-    "TENS": {
-        TENS1_name: visual.TextStim(win,
-                    text=TENS1_name,
-                    color="white",
-                    height=25,
-                    pos=(400, -300),
-                    wrapWidth=300   
-                    ),            
-        TENS2_name: visual.TextStim(win,
-                    text=TENS2_name,
-                    color="white",
-                    height=25,
-                    pos=(-400, -300),
-                    wrapWidth=300   
-                    ),        
+    "TENS": { # named from the participant's plan, warmed up with the screen texts above
+        TENS1_name: text_cache.get(TENS1_name, **text_styles["button_right"]),
+        TENS2_name: text_cache.get(TENS2_name, **text_styles["button_left"]),
     },
     "confirm": {    
         "Yes": visual.TextStim(win,
@@ -613,9 +632,32 @@ buttons = {
 
 }
 
+# countdown, TENS and shock run with the garbage collector off and the process priority raised, and the garbage is
+# collected in the next ITI (see NEE1_critical.py); everything built so far is frozen so those collections stay short
+critical = CriticalSections(win, core.rush)
+critical.freeze()
+startup.mark("stimuli")
+
 calib_finish = False
+pulse_engine = None # TENS pulse engine for the trial currently running
 
 #### Make trial functions
+    # fixation, with the shock sent on the flip that shows it and cleared port_buffer_duration later
+def shock_phase(level):
+    def start_shock():
+        publish("shock", level=level)
+        port_state.set("TENS", 0)
+        win.callOnFlip(port_state.set, "shock", level)
+    return TrialPhase("shock", port_buffer_duration, [fix_stim], enter=start_shock, exit=lambda: port_state.set("shock", 0))
+
+    # pain rating until the participant responds, then left on for response_hold_duration to allow adjusting it
+def rating_phases(slider):
+    return [TrialPhase("rating", None, [pain_text, slider], enter=lambda: responses.onset(sliders=[slider]),
+                       done=lambda: slider.getRating() is not None,
+                       exit=lambda: log_event("rating", int(round(slider.getRating() * 10)))),
+            TrialPhase("rating", response_hold_duration, [pain_text, slider])]
+
+
     # calibration trials
 def show_calib_trial(trial_order):
     trial_index = 0
@@ -626,80 +668,45 @@ def show_calib_trial(trial_order):
     while 0 <= trial_index < len(calib_trial_order) and not calib_finish:
         current_trial = trial_order[trial_index]
         if previous_trial == True:
-            visual.TextStim(win,
-                text=response_instructions["Shock_check"],
-                height = 35,
-                pos = (0,0),
-                wrapWidth= 800
-                ).draw()
             buttons_keylist = ["Yes", "No"]
+            screen = [text_cache.get(response_instructions["Shock_check"], **text_styles["prompt"])]
             for button_name in buttons_keylist:
-                buttons["confirm"][button_name].draw()
-                button_text["confirm"][button_name].draw()
-            mouse = event.Mouse()
-            mouse.clickReset()
-            win.flip()
+                screen += [buttons["confirm"][button_name], button_text["confirm"][button_name]]
+            responses.onset()
+            responses.redraw(screen)
             
-            choice_finish = False
             termination_check()
-            mouse.clickReset()
-            
-            while choice_finish == False:
-                for button_name in buttons_keylist:
-                        if mouse.isPressedIn(buttons["confirm"][button_name]):
-                            if button_name == "Yes":
-                                choice_finish = True
-                                previous_trial = False
-                                wait(iti)
-                                break
-                            elif button_name == "No":
-                                choice_finish = True
-                                calib_finish = True
-                                wait(iti)
-                                return
+            button_name = responses.wait_click({name: buttons["confirm"][name] for name in buttons_keylist},
+                                               screen, check=termination_check)[0]
+            if button_name == "Yes":
+                previous_trial = False
+                wait(iti)
+            elif button_name == "No":
+                calib_finish = True
+                wait(iti)
+                return
             
         # Wait for participant to ready up for shock
-        visual.TextStim(win,
-            text=response_instructions["Shock"],
-            height = 35,
-            pos = (0,0),
-            wrapWidth= 800
-            ).draw()
+        screen = [text_cache.get(response_instructions["Shock"], **text_styles["prompt"])]
         
-        win.flip()
-        event.waitKeys(keyList = ["space"])
+        responses.onset()
+        responses.redraw(screen)
+        responses.wait_keys(["space"], screen, check=termination_check)
         
-        # show fixation stimulus + deliver shock
-        if pport != None:
-            pport.setData(0)
-
-        fix_stim.draw()
-        win.flip()
-        
-        if pport != None:
-            pport.setData(shock_trig["high"])
-            wait(port_buffer_duration)
-            pport.setData(0)
-        
-        # Get pain rating
-        while calib_rating.getRating() is None: # while mouse unclicked
-            termination_check()
-            pain_text.draw()
-            calib_rating.draw()
-            win.flip()
-            
-        pain_response_end_time = core.getTime() + response_hold_duration # amount of time for participants to adjust slider after making a response
-        
-        while core.getTime() < pain_response_end_time:
-            termination_check()
-            pain_text.draw()
-            calib_rating.draw()
-            win.flip()
+        # show fixation stimulus + deliver shock, then get pain rating
+        log_event("trial", 0)
+        port_state.clear() # also releases a field the stall watchdog latched in the last trial
+        with critical.section([fix_stim]):
+            run_phases([shock_phase(shock_trig["high"])], flip, win.monitorFramePeriod, check=termination_check)
+        run_phases(rating_phases(calib_rating), flip, win.monitorFramePeriod, check=termination_check)
 
         current_trial["pain_response"] = calib_rating.getRating()
+        current_trial["pain_rt"] = responses.rating_rt(calib_rating)
         calib_rating.reset()
+        save_trial(current_trial)
         win.flip()
-        wait(iti)
+        sync_data()
+        iti_wait()
 
         # Feedback text
         if shock_trig["high"] == 1:
@@ -709,7 +716,7 @@ def show_calib_trial(trial_order):
         else:
             text = response_instructions["Check_max"]
 
-        visual.TextStim(win, text=text, height=35, pos=(0, 0)).draw()
+        screen = [text_cache.get(text, **text_styles["message"])]
 
         # Draw buttons and text
         if shock_trig["high"] == 1:
@@ -720,190 +727,186 @@ def show_calib_trial(trial_order):
             buttons_keylist = buttons["calibration"].keys()
 
         for button_name in buttons_keylist:
-            buttons["calibration"][button_name].draw()
-            button_text["calibration"][button_name].draw()
+            screen += [buttons["calibration"][button_name], button_text["calibration"][button_name]]
 
-        win.flip()
-        
-        # Wait for a mouse click
-        trial_finish = False
-        mouse = event.Mouse()
-        mouse.clickReset()
+        responses.onset()
+        responses.redraw(screen)
         
-        while trial_finish == False:
-            for button_name, button_rect in buttons["calibration"].items():
-                if mouse.isPressedIn(button_rect):
-                    if button_name == "Next":
-                        shock_trig["high"] += 1
-                        shock_trig["low"] += 1
-                        shock_trig["medium"] += 1
-                        trial_index += 1
-                        
-                    elif button_name == "Stay":
-                        calib_finish = True
-                        
-                    elif button_name == "Previous":
-                        shock_trig["high"] -= 1
-                        shock_trig["low"] -= 1
-                        shock_trig["medium"] -= 1
-                        trial_index -= 1
-                        previous_trial = True
-    
-                    trial_finish = True
-                    mouse.clickReset()                        
+        # Wait for a mouse click on one of the buttons shown
+        button_name = responses.wait_click({name: buttons["calibration"][name] for name in buttons_keylist},
+                                           screen, check=termination_check)[0]
+        if button_name == "Next":
+            shock_trig["high"] += 1
+            shock_trig["low"] += 1
+            shock_trig["medium"] += 1
+            trial_index += 1
+            
+        elif button_name == "Stay":
+            calib_finish = True
+            
+        elif button_name == "Previous":
+            shock_trig["high"] -= 1
+            shock_trig["low"] -= 1
+            shock_trig["medium"] -= 1
+            trial_index -= 1
+            previous_trial = True
         win.flip()
         wait(iti)
 
 def show_trial(current_trial):
-    if pport != None:
-        pport.setData(0)
+    log_event("trial", current_trial["trialnum"])
+    port_state.clear() # also releases a field the stall watchdog latched in the last trial
+    publish("trial_start", trialnum=current_trial["trialnum"], phase=current_trial["phase"],
+            choicetrial=current_trial["choicetrial"], trialtype=current_trial["trialtype"])
+    if flip_log != None:
+        flip_log.begin_trial(current_trial["trialnum"])
         
     win.flip()
     
     #If TENS trial, ask for choice:
     
     if current_trial["choicetrial"] == True:
+        screen = [text_cache.get(response_instructions["Choice"], **text_styles["message"])]
         for button_name in TENS_names:
-            buttons["TENS"][button_name].draw()
-            button_text["TENS"][button_name].draw()
-        visual.TextStim(win,
-                text=response_instructions["Choice"],
-                height = 35,
-                pos = (0,0),
-                ).draw()
+            screen += [buttons["TENS"][button_name], button_text["TENS"][button_name]]
         
-        win.flip()
-
-        choice_finish = False
-        mouse = event.Mouse()
-
-        while choice_finish == False:
-            termination_check()
-            for button_name, button_rect in buttons["TENS"].items():
-                if mouse.isPressedIn(button_rect):
-                    if button_name == TENS_trialtypes["optimal"]:
-                        current_trial["stimulus"] = "TENS"
-                        current_trial["choice_response"] = TENS_trialtypes["optimal"]
-                        current_trial["choice_optimal"] = "optimal"
-                        current_trial["trialtype"] = TENS_trialtypes["optimal"]
-                        current_trial["outcome"] = "medium"
-                        choice_finish = True
-                    elif button_name == TENS_trialtypes["suboptimal"]:
-                        current_trial["stimulus"] = "TENS"
-                        current_trial["choice_response"] = TENS_trialtypes["suboptimal"]
-                        current_trial["choice_optimal"] = "suboptimal"
-                        current_trial["trialtype"] = TENS_trialtypes["suboptimal"]
-                        current_trial["outcome"] = outcome_randomise(
-                            "high",
-                            "low",
-                            current_trial["rft_schedule"])
-                        choice_finish = True
+        responses.onset()
+        responses.redraw(screen)
+
+        button_name, current_trial["choice_rt"] = responses.wait_click(buttons["TENS"], screen, check=termination_check)
+        if button_name == TENS_trialtypes["optimal"]:
+            current_trial["stimulus"] = "TENS"
+            current_trial["choice_response"] = TENS_trialtypes["optimal"]
+            current_trial["choice_optimal"] = "optimal"
+            current_trial["trialtype"] = TENS_trialtypes["optimal"]
+            current_trial["outcome"] = "medium"
+        elif button_name == TENS_trialtypes["suboptimal"]:
+            current_trial["stimulus"] = "TENS"
+            current_trial["choice_response"] = TENS_trialtypes["suboptimal"]
+            current_trial["choice_optimal"] = "suboptimal"
+            current_trial["trialtype"] = TENS_trialtypes["suboptimal"]
+            current_trial["outcome"] = current_trial["suboptimal_outcome"] # drawn from rft_schedule in the plan
+        publish("choice", choice=button_name, choice_optimal=current_trial["choice_optimal"],
+                outcome=current_trial["outcome"], choice_rt=current_trial["choice_rt"])
 
         
-    # Start countdown to shock
-    
-    # Make a count-down screen
-    countdown_timer = core.CountdownTimer(10)  # Set the initial countdown time to 10 seconds
-  
-    while countdown_timer.getTime() > 8:
-        termination_check()
-        countdown_text[str(int(math.ceil(countdown_timer.getTime())))].draw()
-        win.flip()
-        
-    while countdown_timer.getTime() < 8 and countdown_timer.getTime() > 7: #turn on TENS at 8 seconds
-        termination_check()
-        if current_trial["stimulus"] == "TENS":
-            TENS_pulse_pattern_images[current_trial["trialtype"]].draw()
-            TENS_pulse_pattern_text[current_trial["trialtype"]].draw()
-            if pport != None:
-                for time, port in TENS_pulse_patterns[current_trial["trialtype"]]:
-                    termination_check()
-                    if abs(countdown_timer.getTime() - math.floor(countdown_timer.getTime()) - time) < timer_precision_range:
-                        pport.setData(port)
-        countdown_text[str(int(math.ceil(countdown_timer.getTime())))].draw()
-        win.flip()
-
-    while countdown_timer.getTime() < 7 and countdown_timer.getTime() > 0: #ask for expectancy at 7 seconds
-        termination_check()
+    # Countdown to shock, shock and pain rating, run frame by frame
+    TENS_stims = []
+    if current_trial["stimulus"] == "TENS":
+        TENS_stims = [TENS_pulse_pattern_images[current_trial["trialtype"]], TENS_pulse_pattern_text[current_trial["trialtype"]]]
+
+    def draw_countdown(frame):
+        countdown_text[str(countdown[min(frame, len(countdown) - 1)])].draw()
+
+    def draw_TENS(frame):
+        if pulse_engine != None:
+            pulse_engine.poll()
+        draw_countdown(frame)
+
+    # compile the TENS pulse pattern into absolute edge times for the rest of the countdown, fired once each by the
+    # pulse engine from the flip that first shows TENS
+    def start_TENS():
+        global pulse_engine
         if current_trial["stimulus"] == "TENS":
-            TENS_pulse_pattern_images[current_trial["trialtype"]].draw()
-            TENS_pulse_pattern_text[current_trial["trialtype"]].draw()
-            if pport != None:
-                for time, port in TENS_pulse_patterns[current_trial["trialtype"]]:
-                    termination_check()
-                    if abs(countdown_timer.getTime() - math.floor(countdown_timer.getTime()) - time) < timer_precision_range:
-                        pport.setData(port)
-        countdown_text[str(int(math.ceil(countdown_timer.getTime())))].draw()
-        
-        # Ask for expectancy rating
-        exp_text.draw() 
-        exp_rating.draw()
-        win.flip()    
-
-    current_trial["exp_response"] = exp_rating.getRating() #saves the expectancy response for that trial
-    exp_rating.reset() #resets the expectancy slider for subsequent trials
-        
-    # deliver shock
-    if pport != None:
-        pport.setData(0)
-    fix_stim.draw()
-    win.flip()
-    
-    if pport != None:
-        pport.setData(shock_trig[current_trial["outcome"]])
-        
-    wait(port_buffer_duration)
-
-    if pport != None:
-        pport.setData(0)
-
-    # Get pain rating
-    while pain_rating.getRating() is None: # while mouse unclicked
-        termination_check()
-        pain_rating.draw()
-        pain_text.draw()
-        win.flip()
-            
-            
-    pain_response_end_time = core.getTime() + response_hold_duration # amount of time for participants to adjust slider after making a response
-    
-    while core.getTime() < pain_response_end_time:
-        termination_check()
-        pain_text.draw()
-        pain_rating.draw()
-        win.flip()
+            pulse_engine = PulseEngine(PulseTimeline(TENS_pulse_patterns[current_trial["trialtype"]],
+                                                     duration=TENS_on_time,
+                                                     period=TENS_pulse_period),
+                                       port_state.writer("TENS"))
+            win.callOnFlip(pulse_engine.start)
+
+    def end_countdown():
+        global pulse_engine
+        if pulse_engine != None:
+            pulse_engine.stop()
+            TENS_report = pulse_engine.timeline.jitter_report(timer_precision_range)
+            current_trial["TENS_edges"] = TENS_report["fired"]
+            current_trial["TENS_jitter_mean"] = TENS_report["jitter_mean"]
+            current_trial["TENS_jitter_max"] = TENS_report["jitter_max"]
+            if not TENS_report["within_budget"]:
+                print(f"Trial {current_trial['trialnum']}: TENS pulses outside {timer_precision_range}s budget ({TENS_report})")
+            pulse_engine = None
+
+        current_trial["exp_response"] = exp_rating.getRating() #saves the expectancy response for that trial
+        current_trial["exp_rt"] = responses.rating_rt(exp_rating)
+        publish("expectancy", rating=current_trial["exp_response"], exp_rt=current_trial["exp_rt"])
+        exp_rating.reset() #resets the expectancy slider for subsequent trials
+
+    countdown = countdown_numbers(countdown_duration, win.monitorFramePeriod)
+    with critical.section(list(countdown_text.values()) + TENS_stims + [exp_text, exp_rating, fix_stim]):
+        run_phases([TrialPhase("pre_TENS", countdown_duration - TENS_on_time, draw=draw_countdown),
+                    TrialPhase("TENS_on", TENS_on_time - expectancy_time, TENS_stims, draw_TENS, enter=start_TENS), #turn on TENS at 8 seconds
+                    TrialPhase("expectancy", expectancy_time, TENS_stims + [exp_text, exp_rating], draw_TENS, #ask for expectancy at 7 seconds
+                               enter=lambda: responses.onset(sliders=[exp_rating]), exit=end_countdown),
+                    shock_phase(shock_trig[current_trial["outcome"]])],
+                   flip, win.monitorFramePeriod, check=termination_check)
+    run_phases(rating_phases(pain_rating), flip, win.monitorFramePeriod, check=termination_check)
         
     current_trial["pain_response"] = pain_rating.getRating()
+    current_trial["pain_rt"] = responses.rating_rt(pain_rating)
     pain_rating.reset()
+    save_trial(current_trial)
 
     win.flip()
+    sync_data()
     
-    wait(iti)
+    iti_wait()
 
 exp_finish = False
 
+def report_startup(): # called by the first flip of the session
+    startup.mark("first_frame")
+    report = startup.report(preload)
+    print(f"Time to first frame: {report['first_frame_time']:.2f} s after launch, {report['PID_to_first_frame']:.2f} s after the participant ID")
+    journal.record("startup", **report)
+
+win.callOnFlip(report_startup)
+
 
 # Run experiment
 while not exp_finish:
     termination_check()
-    # display welcome and calibration instructions
-    instruction_trial(instructions_text["welcome"],3)
-    instruction_trial(instructions_text["TENS_introduction"],3)
-    instruction_trial(instructions_text["calibration"],8)
-    
-    show_calib_trial(calib_trial_order)
-    
-    instruction_trial(instructions_text["calibration_finish"],3)
-    
-    #display main experiment phase
-    instruction_trial(instructions_text["experiment"],10)
+    if resume_state == None or resume_state["shock_trig"] == None:
+        # display welcome and calibration instructions
+        instruction_trial(instructions_text["welcome"],3)
+        instruction_trial(instructions_text["TENS_introduction"],3)
+        instruction_trial(instructions_text["calibration"],8)
+        
+        show_calib_trial(calib_trial_order)
+        publish("calibrated", **shock_trig)
+        journal.record("calibrated", shock_trig=shock_trig)
+        sync_data()
+        
+        instruction_trial(instructions_text["calibration_finish"],3)
+        
+        #display main experiment phase
+        instruction_trial(instructions_text["experiment"],10)
+    else:
+        # calibration was already done before the session was interrupted
+        instruction_trial(instructions_text["resume"],3)
+        
     for trial in trial_order:
     # for trial in [t for t in trial_order if t["phase"] == "extinction"]: #for testing extinction
+        if resume_state != None and trial["trialnum"] in resume_state["completed"]:
+            continue
         show_trial(trial)
 
-    pport.setData(0) # Set all pins to 0 to shut off TENS, shock etc.    
+    port_state.clear() # Set all pins to 0 to shut off TENS, shock etc.    
+    print(f"wait() overshoot: {wait_overshoot.summary()}")
+    print(f"port writes: {port_state.stats()}")
+    print(f"stall watchdog incidents: {len(stall_watchdog.incidents)}")
+    if stall_watchdog.incidents:
+        journal.record("incidents", incidents=stall_watchdog.incidents)
+    pause_report = critical.pause_report()
+    print(f"garbage collections: {pause_report['critical']['n']} in critical sections, "
+          f"{pause_report['outside']['n']} outside (max {pause_report['outside'].get('max', 0) * 1000:.2f} ms), "
+          f"{pause_report['deferred']['n']} deferred to the ITI (max {pause_report['deferred'].get('max', 0) * 1000:.2f} ms)")
+    journal.record("gc_pauses", **pause_report)
     # # save trial data
-    save_data(trial_order)
+    publish("finished", port_writes=port_state.stats())
+    log_event("session", 0)
+    journal.record("finished")
+    journal.close()
+    save_data()
     exit_screen(instructions_text["end"])
     
     exp_finish = True
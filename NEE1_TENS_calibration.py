@@ -1,7 +1,23 @@
+from psychopy import core, event, gui, visual, prefs
+import csv
+import os
+import sys
+import time
+from NEE1_port import open_port
+from NEE1_timing import PulseTimeline, PulseEngine, TimingStats, square_wave
+ports_live = True # Set to None to run without the parallel port
+port_address = 0xDFD8 #Get from device Manager (this station's address, NEE1.py has its own)
+pport = open_port(ports_live, port_address)
 
-from psychopy import core, event, gui, visual, parallel, prefs
-pport = parallel.ParallelPort(address=0xDFD8)
-TENS_pulse_int = 0.1 # interval length for TENS on/off signals (e.g. 0.1 = 0.2s per pulse) NOTE; likely only 1 decimal place precision
+# TENS square wave: python NEE1_TENS_calibration.py [frequency in Hz] [duty cycle]
+TENS_frequency = float(sys.argv[1]) if len(sys.argv) > 1 else 5 # pulses per second (5 Hz = 0.1s on, 0.1s off)
+TENS_duty_cycle = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5 # fraction of each period the TENS pin is on
+TENS_trig = 128
+calibration_duration = 300 # pulses stop after this many seconds if space has not been pressed
+spin_time = 0.002 # the pulse thread sleeps until this close to each edge and then spins (see python NEE1_timing.py overshoot)
+
+# edges are scheduled against absolute deadlines from the start, so timing errors do not add up over the run
+TENS_pattern, TENS_period = square_wave(TENS_frequency, TENS_duty_cycle, TENS_trig)
 
 win = visual.Window(
     size=(1920, 1080), fullscr= True, screen=0,
@@ -20,19 +36,39 @@ visual.TextStim(win,
 
 win.flip()
 
-calib_finish = False
-countdown_timer = core.CountdownTimer(300)
-TENS_timer = countdown_timer.getTime() + TENS_pulse_int
+pulse_engine = PulseEngine(PulseTimeline(TENS_pattern, duration=calibration_duration, period=TENS_period),
+                           pport.setData, spin_time=spin_time)
+pulse_engine.start()
+event.waitKeys(maxWait=calibration_duration, keyList=["space"]) # spacebar ends calibration
+pulse_engine.stop()
+pport.setData(0)
+
+# Achieved timing: period and on-time of every pulse, and how late each edge was sent
+timeline = pulse_engine.timeline
+periods = TimingStats(timeline.intervals(TENS_trig, TENS_trig)).summary()
+on_times = TimingStats(timeline.intervals(TENS_trig, 0)).summary()
+lateness = TimingStats([j for j in timeline.jitter() if j is not None]).summary()
+print(f"TENS {TENS_frequency} Hz, duty cycle {TENS_duty_cycle}: {lateness['n']} edges sent")
+if periods["n"]:
+    print(f"period {TENS_period * 1000:.3f} ms nominal: mean {periods['mean'] * 1000:.3f} ms, "
+          f"p99 {periods['p99'] * 1000:.3f} ms, max {periods['max'] * 1000:.3f} ms")
+    print(f"on-time {TENS_duty_cycle * TENS_period * 1000:.3f} ms nominal: mean {on_times['mean'] * 1000:.3f} ms, "
+          f"max {on_times['max'] * 1000:.3f} ms; edge lateness p99 {lateness['p99'] * 1000:.3f} ms, max {lateness['max'] * 1000:.3f} ms")
 
-while calib_finish == False:
-    keys_pressed = event.getKeys()  
-    if 'space' in keys_pressed:  # Check for "spacebar" to end calibration
-        calib_finish = True
-    if countdown_timer.getTime() < TENS_timer - TENS_pulse_int:
-        pport.setData(128)
-    if countdown_timer.getTime() < TENS_timer - TENS_pulse_int*2:
-        pport.setData(0)
-        TENS_timer = countdown_timer.getTime() 
+# one row per calibration run in data/TENS_calibration_log.csv
+data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+os.makedirs(data_folder, exist_ok=True)
+log_filepath = os.path.join(data_folder, "TENS_calibration_log.csv")
+log_fields = {"datetime": time.strftime("%Y-%m-%d_%H.%M.%S"), "frequency": TENS_frequency, "duty_cycle": TENS_duty_cycle,
+              "edges": lateness["n"], "period_nominal": TENS_period,
+              "period_mean": periods.get("mean"), "period_p99": periods.get("p99"), "period_max": periods.get("max"),
+              "on_time_mean": on_times.get("mean"), "on_time_max": on_times.get("max"),
+              "lateness_mean": lateness.get("mean"), "lateness_p99": lateness.get("p99"), "lateness_max": lateness.get("max")}
+write_header = not os.path.exists(log_filepath)
+with open(log_filepath, mode="a", newline="") as log_file:
+    writer = csv.DictWriter(log_file, fieldnames=list(log_fields))
+    if write_header:
+        writer.writeheader()
+    writer.writerow(log_fields)
 
-pport.setData(0)
 core.quit()
\ No newline at end of file
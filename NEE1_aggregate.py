@@ -0,0 +1,157 @@
+# Cohort summaries of the data/ folder, updated incrementally
+# Each finished <PID>_responses.csv is parsed once into per-participant totals (sums and counts, which add up across
+# participants) and recorded in a manifest with its size, mtime and hash. A refresh only lists the folder, parses the
+# files that are new or changed and adds the difference to the cohort totals, so it costs time in proportion to new data.
+import csv
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+
+manifest_name = "cohort_manifest.json"
+data_suffix = "_responses.csv" # written by TrialWriter.finalize(); .partial files are sessions still running
+
+
+# Totals for one data file: choice[group_name][blocknum] = [optimal choices, choices] and
+# pain[trialtype][phase] = [sum of pain ratings, ratings]
+def participant_totals(rows):
+    totals = {"choice": {}, "pain": {}}
+    for row in rows:
+        if row["choicetrial"] == "True" and row["choice_optimal"] in ("optimal", "suboptimal"):
+            cell = totals["choice"].setdefault(row["group_name"], {}).setdefault(row["blocknum"], [0, 0])
+            cell[0] += row["choice_optimal"] == "optimal"
+            cell[1] += 1
+        if row["pain_response"] not in ("", None):
+            cell = totals["pain"].setdefault(row["trialtype"], {}).setdefault(row["phase"], [0, 0])
+            cell[0] += float(row["pain_response"])
+            cell[1] += 1
+    return totals
+
+
+# Add (sign=1) or take away (sign=-1) one participant's totals; cells left with no observations are dropped
+def add_totals(cohort, totals, sign=1):
+    for table, outer_cells in totals.items():
+        for outer, inner_cells in outer_cells.items():
+            cohort_cells = cohort[table].setdefault(outer, {})
+            for inner, (total, count) in inner_cells.items():
+                cell = cohort_cells.setdefault(inner, [0, 0])
+                cell[0] += sign * total
+                cell[1] += sign * count
+                if cell[1] == 0:
+                    del cohort_cells[inner]
+            if not cohort_cells:
+                del cohort[table][outer]
+
+
+def block_order(blocknum):
+    return (0, int(blocknum), "") if blocknum.isdigit() else (1, 0, blocknum)
+
+
+class CohortAggregate:
+    def __init__(self, data_folder, manifest_path=None):
+        self.data_folder = data_folder
+        self.manifest_path = manifest_path or os.path.join(data_folder, manifest_name)
+        self.files = {} # file name: size, mtime_ns, sha256, PID, rows and totals
+        self.cohort = {"choice": {}, "pain": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            self.files = manifest["files"]
+            self.cohort = manifest["cohort"]
+
+    # Bring the totals up to date with the folder; returns how many files were new, changed, removed or unchanged
+    def refresh(self):
+        counts = {"new": 0, "changed": 0, "removed": 0, "unchanged": 0}
+        seen = set()
+        with os.scandir(self.data_folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith(data_suffix) or not entry.is_file():
+                    continue
+                seen.add(entry.name)
+                stat = entry.stat()
+                known = self.files.get(entry.name)
+                if known != None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                    counts["unchanged"] += 1
+                    continue
+
+                with open(entry.path, "rb") as data_file:
+                    content = data_file.read()
+                digest = hashlib.sha256(content).hexdigest()
+                if known != None and known["sha256"] == digest: # touched or copied, same contents
+                    known.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                    counts["unchanged"] += 1
+                    continue
+
+                rows = list(csv.DictReader(io.StringIO(content.decode("utf-8"), newline="")))
+                totals = participant_totals(rows)
+                if known != None:
+                    add_totals(self.cohort, known["totals"], -1)
+                add_totals(self.cohort, totals)
+                self.files[entry.name] = {"size": stat.st_size,
+                                          "mtime_ns": stat.st_mtime_ns,
+                                          "sha256": digest,
+                                          "PID": entry.name[:-len(data_suffix)],
+                                          "rows": len(rows),
+                                          "totals": totals}
+                counts["changed" if known != None else "new"] += 1
+
+        for name in set(self.files) - seen:
+            add_totals(self.cohort, self.files.pop(name)["totals"], -1)
+            counts["removed"] += 1
+
+        if counts["new"] or counts["changed"] or counts["removed"] or not os.path.exists(self.manifest_path):
+            self.save()
+        return counts
+
+    def save(self):
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w") as manifest_file:
+            json.dump({"files": self.files, "cohort": self.cohort}, manifest_file)
+        os.replace(temp_path, self.manifest_path)
+
+    # Rate of optimal choices per group and block, for the cohort or (given a PID) one participant
+    def choice_rates(self, PID=None):
+        choice = self.totals(PID)["choice"]
+        return [{"group_name": group_name, "blocknum": blocknum, "choices": count, "optimal_rate": optimal / count}
+                for group_name in sorted(choice)
+                for blocknum, (optimal, count) in sorted(choice[group_name].items(), key=lambda item: block_order(item[0]))]
+
+    # Mean pain rating per trial type and phase, for the cohort or one participant
+    def pain_means(self, PID=None):
+        pain = self.totals(PID)["pain"]
+        return [{"trialtype": trialtype, "phase": phase, "ratings": count, "pain_mean": total / count}
+                for trialtype in sorted(pain)
+                for phase, (total, count) in sorted(pain[trialtype].items())]
+
+    def totals(self, PID=None):
+        if PID == None:
+            return self.cohort
+        return self.files[str(PID) + data_suffix]["totals"]
+
+    def write_summary(self, folder=None):
+        folder = folder or self.data_folder
+        for name, rows in [("cohort_choice_rates.csv", self.choice_rates()), ("cohort_pain_means.csv", self.pain_means())]:
+            with open(os.path.join(folder, name), mode="w", newline="") as summary_file:
+                writer = csv.DictWriter(summary_file, fieldnames=list(rows[0].keys()) if rows else [])
+                writer.writeheader()
+                writer.writerows(rows)
+
+
+# python NEE1_aggregate.py [data folder]  -> refresh the manifest and write cohort_choice_rates.csv and cohort_pain_means.csv
+if __name__ == "__main__":
+    data_folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+    start = time.perf_counter()
+    aggregate = CohortAggregate(data_folder)
+    counts = aggregate.refresh()
+    aggregate.write_summary()
+    print(f"{len(aggregate.files)} participants ({counts['new']} new, {counts['changed']} changed, "
+          f"{counts['removed']} removed) refreshed in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    print("optimal choice rate by group and block:")
+    for row in aggregate.choice_rates():
+        print(f"  {row['group_name']:10s} block {row['blocknum']:>2s}: {row['optimal_rate']:.2f} ({row['choices']} choices)")
+    print("mean pain rating by trial type and phase:")
+    for row in aggregate.pain_means():
+        print(f"  {row['trialtype']:11s} {row['phase']:12s}: {row['pain_mean']:5.1f} ({row['ratings']} ratings)")
@@ -0,0 +1,192 @@
+# Timing benchmarks for NEE1 with regression budgets
+# Runs the timing-critical paths without a window or a parallel port, measures them and compares each result with its
+# budget, so a timing regression shows up on the lab PC before a session does:
+#   wait_overshoot   how late wait() (sleep_until) wakes up, on the real clock
+#   pulse_jitter     how late TENS pulse edges reach the port, both patterns, real clock, through PortState
+#   frame_cost       real time the script spends between flips, over a simulated session (fake psychopy)
+#   telemetry        publish() calls made in one frame, with the telemetry shipper running and no viewer
+#   event_log        one event (a port edge) logged to the binary event log, with the flusher running
+#   escape           escape key going down to the port reading 0, through the escape watcher thread
+#   stall            port cleared by the stall watchdog, past the heartbeat timeout or a field's maximum on-time
+#   gc               frames making cyclic garbage, with the collector on and inside a critical section
+#   save_trial       journal record + data row written during a trial
+#   save_sync        sync_data() at the ITI (journal and data file fsync)
+#   save_finalize    finalize() at the end of the session
+# Each run is appended to data/benchmark_log.csv.
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+
+from NEE1_data import TrialWriter, SessionJournal
+from NEE1_port import PortState, RecordingPort
+from NEE1_records import Trial, TrialStore, data_columns
+from NEE1_schedule import session_plan
+from NEE1_simulate import SimulatedSession, load_script, script_settings
+from NEE1_telemetry import measure_overhead
+from NEE1_eventlog import measure_cost
+from NEE1_watchdog import measure_escape_latency, measure_stalls
+from NEE1_critical import measure_pauses
+from NEE1_timing import PulseTimeline, PulseEngine, TimingStats, sleep_until, default_clock
+
+settings = script_settings(["iti", "wait_spin_time", "TENS_trig", "TENS_pulse_pattern_list", "TENS_pulse_period",
+                            "timer_precision_range"])
+
+# result: largest acceptable value in seconds (override with a JSON file, see the bottom of this file)
+budgets = {"wait_overshoot_p99": 0.002,
+           "pulse_jitter_max": settings["timer_precision_range"],
+           "frame_cost_p99": 0.002, # a 60 Hz frame is 16.7 ms
+           "telemetry_frame_p99": 0.00005,
+           "event_log_p99": 0.00001,
+           "escape_to_port_max": 0.005,
+           "stall_clear_late_max": 0.02, # poll interval + thread wake-up: ~2 ms on a quiet machine, 14 ms seen under load
+           "gc_pause_critical_max": 0.0, # no collection may run inside a critical section
+           "save_trial_max": 0.005,
+           "save_sync_p99": 0.1, # has to finish well within the ITI
+           "save_finalize": 0.5}
+
+
+def bench_wait(repeats=200, duration=0.01):
+    stats = TimingStats()
+    for _ in range(repeats):
+        stats.add(sleep_until(default_clock.now() + duration, spin_time=settings["wait_spin_time"]))
+    return stats.summary()
+
+
+def bench_pulses(duration=3):
+    stats = TimingStats()
+    for pattern in settings["TENS_pulse_pattern_list"].values():
+        port = PortState(RecordingPort(), {"TENS": settings["TENS_trig"], "shock": 0x7F})
+        engine = PulseEngine(PulseTimeline(pattern, duration, settings["TENS_pulse_period"]), port.writer("TENS"))
+        engine.start()
+        while not engine.timeline.finished():
+            time.sleep(0.05)
+        engine.stop()
+        for lateness in engine.timeline.jitter():
+            stats.add(float("inf") if lateness is None else lateness)
+    return stats.summary()
+
+
+def bench_frames(PID=1):
+    with tempfile.TemporaryDirectory() as data_root:
+        session = SimulatedSession(PID, data_root)
+        session.run(load_script())
+    return session.frame_costs.summary()
+
+
+def bench_telemetry():
+    return measure_overhead("127.0.0.1:9") # discard port, so a viewer left running is not flooded
+
+
+def bench_event_log():
+    with tempfile.TemporaryDirectory() as folder:
+        return measure_cost(os.path.join(folder, "events.bin"))[0]
+
+
+def bench_escape():
+    return measure_escape_latency()[0]
+
+
+def bench_stall():
+    stall_late, on_time_late, _, rearmed = measure_stalls()
+    if rearmed: # the pulses switched a latched field back on: fail whatever the latency
+        return float("inf")
+    return max(stall_late["max"], on_time_late["max"])
+
+
+def bench_gc():
+    outside, critical, report = measure_pauses()
+    return outside, critical, report["critical"].get("max", 0.0)
+
+
+def bench_save(PID=1):
+    trial_order = [Trial(**trial) for trial in session_plan(PID)["trial_order"]]
+    store = TrialStore({"datetime": time.strftime("%Y-%m-%d_%H.%M.%S"), "PID": str(PID), "group": 1,
+                        "group_name": "consistent", "cb": 0, "optimalTENS_name": "bipolar", "optimalTENS_pattern": "pause"})
+    trial_stats = TimingStats()
+    sync_stats = TimingStats()
+    with tempfile.TemporaryDirectory() as folder:
+        csv_filepath = os.path.join(folder, f"{PID}_responses.csv")
+        writer = TrialWriter(csv_filepath, data_columns)
+        journal = SessionJournal(os.path.join(folder, f"{PID}_journal.jsonl"))
+        for trial in trial_order:
+            start = time.perf_counter()
+            trial["shock_level_high"] = 5
+            row = store.append(trial)
+            journal.record("trial", trial=trial.as_dict())
+            writer.writerow(row)
+            trial_stats.add(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            journal.sync()
+            writer.sync()
+            sync_stats.add(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        journal.close()
+        writer.finalize()
+        finalize = time.perf_counter() - start
+    return trial_stats.summary(), sync_stats.summary(), finalize
+
+
+def run_benchmarks():
+    wait = bench_wait()
+    pulses = bench_pulses()
+    frames = bench_frames()
+    telemetry = bench_telemetry()
+    event_log = bench_event_log()
+    escape = bench_escape()
+    stall_clear_late = bench_stall()
+    gc_outside, gc_critical, gc_pause_critical = bench_gc()
+    save_trial, save_sync, save_finalize = bench_save()
+    return {"wait_overshoot_p99": wait["p99"],
+            "wait_overshoot_max": wait["max"],
+            "pulse_jitter_p99": pulses["p99"],
+            "pulse_jitter_max": pulses["max"],
+            "frame_cost_p50": frames["p50"],
+            "frame_cost_p99": frames["p99"],
+            "telemetry_frame_p99": telemetry["p99"],
+            "event_log_p99": event_log["p99"],
+            "escape_to_port_p50": escape["p50"],
+            "escape_to_port_max": escape["max"],
+            "stall_clear_late_max": stall_clear_late,
+            "gc_frame_p99": gc_outside["p99"],
+            "gc_section_frame_p99": gc_critical["p99"],
+            "gc_pause_critical_max": gc_pause_critical,
+            "save_trial_max": save_trial["max"],
+            "save_sync_p99": save_sync["p99"],
+            "save_finalize": save_finalize}
+
+
+# python NEE1_benchmark.py [budgets.json]  -> exits with status 1 if any result is over its budget
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as budget_file:
+            budgets.update(json.load(budget_file))
+
+    results = run_benchmarks()
+    failed = []
+    for name, value in results.items():
+        budget = budgets.get(name)
+        status = "" if budget is None else ("ok" if value <= budget else "OVER BUDGET")
+        if budget is not None and value > budget:
+            failed.append(name)
+        budget_text = "" if budget is None else f"budget {budget * 1000:8.3f} ms"
+        print(f"{name:20s} {value * 1000:9.3f} ms  {budget_text:22s} {status}")
+
+    data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+    os.makedirs(data_folder, exist_ok=True)
+    log_filepath = os.path.join(data_folder, "benchmark_log.csv")
+    log_fields = dict({"datetime": time.strftime("%Y-%m-%d_%H.%M.%S")}, **results, failed=" ".join(failed))
+    write_header = not os.path.exists(log_filepath)
+    with open(log_filepath, mode="a", newline="") as log_file:
+        writer = csv.DictWriter(log_file, fieldnames=list(log_fields))
+        if write_header:
+            writer.writeheader()
+        writer.writerow(log_fields)
+
+    if failed:
+        print(f"over budget: {', '.join(failed)}")
+        sys.exit(1)
@@ -0,0 +1,457 @@
+# Central trial collection for several NEE1 stations
+# Each booth still writes its own data/ folder. A collector can also run on one machine (python NEE1_collector.py serve).
+# Each station then streams its completed trial records to the collector over a local socket, as JSON lines.
+#   claim    the station asks for a participant ID when it is typed in. The collector refuses a PID that another station
+#            has claimed (or that this station has claimed before, unless the session is being resumed), so a PID can
+#            only be used once across the lab.
+#   trial    one saved trial row, numbered by its position in the session (seq). The collector queues incoming records
+#            and commits them in batches, one append and fsync per participant file (collected/<PID>_trials.jsonl),
+#            then acknowledges the seqs committed. Records it already has are acknowledged and dropped, so a station can
+#            resend freely.
+# Backpressure: the queue between the connections and the committer is bounded. While it is full the collector stops
+# reading from the sockets and TCP makes the stations wait. The stations' writes happen on a background thread, so the
+# experiment itself never waits.
+# Spool: every record is also appended to <data>/<PID>_spool.jsonl on the station, with a line for each
+# acknowledgement. Records the collector has not acknowledged are resent whenever the station reconnects, including
+# from the spool files of earlier runs. A spool is deleted once all of it has been acknowledged.
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+line_limit = 2 ** 20 # longest message in bytes
+state_name = "collector_state.json"
+
+
+def encode(message):
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class CollectorServer:
+    def __init__(self, folder, batch_size=64, batch_interval=0.05, max_pending=256):
+        self.folder = folder
+        self.conflict_folder = os.path.join(folder, "conflicts")
+        self.state_path = os.path.join(folder, state_name)
+        self.batch_size = batch_size # most records in one commit
+        self.batch_interval = batch_interval # how long a commit waits for more records to share it
+        self.max_pending = max_pending # records queued before the collector stops reading from the stations
+        self.claims = {} # PID: station
+        self.committed = {} # "station PID": [every seq below this is on disk, seqs above it that are on disk]
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+            self.claims = state["claims"]
+            self.committed = state["committed"]
+        os.makedirs(folder, exist_ok=True)
+        self.stats = {"records": 0, "duplicates": 0, "conflicts": 0, "batches": 0, "rejected_claims": 0}
+        self.writers = set()
+        self.lock = threading.Lock() # commits run on a worker thread
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.queue = asyncio.Queue(self.max_pending)
+        self.server = await asyncio.start_server(self.handle, host, port, limit=line_limit)
+        self.committer = asyncio.create_task(self.commit_batches())
+        return self.server.sockets[0].getsockname()[:2]
+
+    # Stop accepting, commit what is queued and drop the connections (stations spool and reconnect)
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.queue.join()
+        self.committer.cancel()
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message["type"] == "claim":
+                    writer.write(encode(self.claim(message["station"], message["PID"], message["resume"])))
+                    await writer.drain()
+                elif message["type"] == "trial":
+                    await self.queue.put((writer, message)) # waits while the queue is full, so this station's socket is not read
+        except (ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def claim(self, station, PID, resume):
+        with self.lock:
+            owner = self.claims.get(PID)
+            if owner == None or (owner == station and resume):
+                self.claims[PID] = station
+                self.save_state()
+                return {"type": "claim", "PID": PID, "ok": True}
+        self.stats["rejected_claims"] += 1
+        return {"type": "claim", "PID": PID, "ok": False, "owner": owner}
+
+    async def commit_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            acks = await asyncio.to_thread(self.commit, batch)
+            for writer, ack in acks:
+                if not writer.is_closing():
+                    writer.write(encode(ack))
+            for _ in batch:
+                self.queue.task_done()
+
+    # Write a batch to disk (on a worker thread); returns the acknowledgements to send
+    def commit(self, batch):
+        with self.lock:
+            lines = {} # file path: lines to append
+            acks = {} # (writer, PID): seqs
+            committed = {key: [below, list(above)] for key, (below, above) in self.committed.items()}
+            for writer, message in batch:
+                station, PID, seq = message["station"], message["PID"], message["seq"]
+                acks.setdefault((writer, PID), []).append(seq)
+                below, above = committed.setdefault(f"{station} {PID}", [0, []])
+                if seq < below or seq in above:
+                    self.stats["duplicates"] += 1
+                    continue
+                above.append(seq)
+                while below in above:
+                    above.remove(below)
+                    below += 1
+                committed[f"{station} {PID}"][0] = below
+
+                owner = self.claims.setdefault(PID, station) # a station that could not reach the collector at the prompt
+                if owner == station:
+                    path = os.path.join(self.folder, f"{PID}_trials.jsonl")
+                else: # kept apart, for the experimenters to sort out
+                    os.makedirs(self.conflict_folder, exist_ok=True)
+                    path = os.path.join(self.conflict_folder, f"{PID}_{station}_trials.jsonl")
+                    self.stats["conflicts"] += 1
+                lines.setdefault(path, []).append(json.dumps({"station": station, "seq": seq, "trial": message["trial"]}) + "\n")
+                self.stats["records"] += 1
+
+            for path, path_lines in lines.items():
+                with open(path, mode="a") as collected_file:
+                    collected_file.writelines(path_lines)
+                    collected_file.flush()
+                    os.fsync(collected_file.fileno())
+            self.committed = committed
+            self.save_state()
+            self.stats["batches"] += 1
+        return [(writer, {"type": "ack", "PID": PID, "seqs": seqs}) for (writer, PID), seqs in acks.items()]
+
+    def save_state(self):
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as state_file:
+            json.dump({"claims": self.claims, "committed": self.committed}, state_file)
+        os.replace(temp_path, self.state_path)
+
+
+# Station side. The event loop runs on a background thread; send() only hands the record over, so it costs the
+# experiment a few microseconds. claim() is the only call that waits on the collector (at the participant ID prompt).
+class CollectorClient:
+    def __init__(self, address, spool_folder, station=None, retry_interval=0.5, max_retry_interval=10):
+        self.host, self.port = parse_address(address)
+        self.spool_folder = spool_folder
+        self.station = station or socket.gethostname()
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.unacked = {} # (PID, seq): encoded record, in the order sent
+        self.spools = {} # PID: open spool file
+        self.claims = {} # PID: future for the collector's reply
+        self.owner = None # station holding the PID of the last refused claim
+        self.connected = asyncio.Event()
+        self.outbox = asyncio.Queue() # encoded messages for the current connection
+        self.closing = False
+        self.runner = None # the run() task, once the loop has started it
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="NEE1 collector", daemon=True)
+
+    def start(self):
+        os.makedirs(self.spool_folder, exist_ok=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.run(), self.loop)
+        return self
+
+    # True if the PID is free (and now claimed by this station), False if it is taken, None if the collector can't be reached
+    def claim(self, PID, resume=False, timeout=2):
+        try:
+            reply = asyncio.run_coroutine_threadsafe(self._claim(str(PID), resume, timeout), self.loop).result(timeout + 1)
+        except (asyncio.TimeoutError, TimeoutError):
+            return None
+        if reply != None and not reply["ok"]:
+            self.owner = reply.get("owner")
+        return None if reply == None else reply["ok"]
+
+    def send(self, PID, seq, trial):
+        self.loop.call_soon_threadsafe(self._enqueue, {"type": "trial", "station": self.station,
+                                                       "PID": str(PID), "seq": seq, "trial": trial})
+
+    # Wait up to timeout seconds for the collector to acknowledge everything, then stop; returns the records still unacknowledged
+    def close(self, timeout=5):
+        if not self.thread.is_alive(): # never started, or its loop has already stopped
+            self._close_spools()
+            return len(self.unacked)
+        try:
+            asyncio.run_coroutine_threadsafe(self._flush(timeout), self.loop).result(timeout + 1)
+        except (asyncio.TimeoutError, TimeoutError):
+            pass
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result(1)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=1)
+        return len(self.unacked)
+
+    async def _claim(self, PID, resume, timeout):
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        reply = self.claims[PID] = self.loop.create_future()
+        self.outbox.put_nowait(encode({"type": "claim", "station": self.station, "PID": PID, "resume": resume}))
+        try:
+            return await asyncio.wait_for(reply, timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            return None
+
+    async def _flush(self, timeout):
+        self.closing = True
+        deadline = self.loop.time() + timeout
+        while self.unacked and self.loop.time() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def _stop(self):
+        if self.runner != None:
+            self.runner.cancel()
+            await asyncio.gather(self.runner, return_exceptions=True)
+        self._close_spools()
+
+    def _close_spools(self):
+        for spool in self.spools.values():
+            spool.close()
+
+    def spool_path(self, PID):
+        return os.path.join(self.spool_folder, f"{PID}_spool.jsonl")
+
+    def _enqueue(self, record):
+        line = encode(record)
+        self._spool(record["PID"], line)
+        self.unacked[record["PID"], record["seq"]] = line
+        if self.connected.is_set():
+            self.outbox.put_nowait(line)
+
+    def _spool(self, PID, line):
+        if PID not in self.spools:
+            self.spools[PID] = open(self.spool_path(PID), mode="ab")
+        self.spools[PID].write(line)
+        self.spools[PID].flush()
+
+    # Records left unacknowledged by earlier runs of this station
+    def load_spools(self):
+        for name in os.listdir(self.spool_folder):
+            if not name.endswith("_spool.jsonl"):
+                continue
+            records = {}
+            with open(os.path.join(self.spool_folder, name), "rb") as spool_file:
+                for line in spool_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # last line cut off
+                        break
+                    if entry["type"] == "trial":
+                        records[entry["seq"]] = line
+                    else:
+                        for seq in entry["seqs"]:
+                            records.pop(seq, None)
+            PID = name[:-len("_spool.jsonl")]
+            for seq, line in sorted(records.items()):
+                self.unacked[PID, seq] = line
+            if not records:
+                os.remove(os.path.join(self.spool_folder, name))
+
+    def _acknowledge(self, PID, seqs):
+        acked = [(PID, seq) for seq in seqs if (PID, seq) in self.unacked]
+        if not acked:
+            return
+        for key in acked:
+            del self.unacked[key]
+        self._spool(PID, encode({"type": "ack", "PID": PID, "seqs": seqs}))
+        if not any(key[0] == PID for key in self.unacked):
+            self.spools.pop(PID).close()
+            os.remove(self.spool_path(PID))
+
+    async def run(self):
+        self.runner = asyncio.current_task()
+        self.load_spools()
+        retry_interval = self.retry_interval
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=line_limit)
+            except OSError: # collector down: records stay in the spool
+                await asyncio.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, self.max_retry_interval)
+                continue
+            retry_interval = self.retry_interval
+            self.outbox = asyncio.Queue()
+            for line in self.unacked.values():
+                self.outbox.put_nowait(line)
+            self.connected.set()
+            sender = asyncio.create_task(self._send_lines(writer))
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    reply = json.loads(line)
+                    if reply["type"] == "ack":
+                        self._acknowledge(reply["PID"], reply["seqs"])
+                    elif reply["type"] == "claim" and reply["PID"] in self.claims:
+                        self.claims.pop(reply["PID"]).set_result(reply)
+            except (ConnectionError, ValueError):
+                pass
+            finally:
+                self.connected.clear()
+                sender.cancel()
+                await asyncio.gather(sender, return_exceptions=True)
+                writer.close()
+                for reply in self.claims.values():
+                    if not reply.done():
+                        reply.set_exception(ConnectionError())
+                self.claims = {}
+            await asyncio.sleep(retry_interval)
+
+    async def _send_lines(self, writer):
+        try:
+            while True:
+                writer.write(await self.outbox.get())
+                await writer.drain() # waits while the collector is not reading
+        except ConnectionError:
+            pass
+
+
+def run_server(folder, address):
+    async def serve():
+        server = CollectorServer(folder)
+        host, port = await server.start(*parse_address(address))
+        print(f"collecting into {folder} on {host}:{port}")
+        while True:
+            await asyncio.sleep(60)
+            print(f"{time.strftime('%H:%M:%S')} {server.stats}")
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+# Several stations on this machine, each running sessions with the trial rows of their participants' session plans.
+# The collector starts late, is restarted mid-way and has a small queue, and one station tries to reuse another's PID.
+# Checks that every trial reached the collector exactly once and in order.
+def simulate_stations(stations=4, sessions=3, trial_interval=0.002):
+    import tempfile
+    from NEE1_schedule import session_plan
+    from NEE1_timing import TimingStats
+
+    with tempfile.TemporaryDirectory() as root:
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        address = "127.0.0.1:%d" % probe.getsockname()[1]
+        probe.close()
+
+        server_loop = asyncio.new_event_loop()
+        threading.Thread(target=server_loop.run_forever, daemon=True).start()
+        collected_folder = os.path.join(root, "collected")
+        server = None
+
+        def start_server():
+            server = CollectorServer(collected_folder, max_pending=16)
+            asyncio.run_coroutine_threadsafe(server.start(*parse_address(address)), server_loop).result()
+            return server
+
+        send_cost = TimingStats()
+        first_claimed = threading.Event()
+        expected = {}
+        rejected = []
+        errors = []
+
+        def station(number):
+            try:
+                client = CollectorClient(address, os.path.join(root, f"station{number}", "data"), f"station{number}").start()
+                for session in range(sessions):
+                    PID = str(number * 100 + session + 1)
+                    client.claim(PID)
+                    if number == 0:
+                        first_claimed.set()
+                    elif session == 0 and first_claimed.wait(10) and client.claim("1") == False: # station 0's first PID
+                        rejected.append(number)
+                    rows = session_plan(PID)["trial_order"]
+                    for seq, trial in enumerate(rows):
+                        start = time.perf_counter()
+                        client.send(PID, seq, trial)
+                        send_cost.add(time.perf_counter() - start)
+                        time.sleep(trial_interval)
+                    expected[PID] = rows
+                unacked = client.close(timeout=20)
+                if unacked:
+                    errors.append(f"station{number}: {unacked} records not acknowledged")
+            except Exception as error:
+                errors.append(f"station{number}: {error!r}")
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=station, args=(number,)) for number in range(stations)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.3) # stations spool while the collector is down
+        server = start_server()
+        time.sleep(0.3)
+        asyncio.run_coroutine_threadsafe(server.stop(), server_loop).result()
+        time.sleep(0.2)
+        restarted = start_server() # picks up its claims and committed records from collector_state.json
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        asyncio.run_coroutine_threadsafe(restarted.stop(), server_loop).result()
+        server_loop.call_soon_threadsafe(server_loop.stop)
+
+        for PID, rows in expected.items():
+            with open(os.path.join(collected_folder, f"{PID}_trials.jsonl")) as collected_file:
+                records = sorted((json.loads(line) for line in collected_file), key=lambda record: record["seq"])
+            if [record["seq"] for record in records] != list(range(len(rows))) or [record["trial"] for record in records] != rows:
+                errors.append(f"PID {PID}: collected trials do not match the session")
+        stats = {name: server.stats[name] + restarted.stats[name] for name in server.stats}
+        return {"trials": sum(len(rows) for rows in expected.values()), "elapsed": elapsed, "stats": stats,
+                "rejected_claims": len(rejected), "send_cost": send_cost.summary(), "errors": errors}
+
+
+# python NEE1_collector.py serve [folder] [host:port]   -> collect trials from the stations (NEE1.py collector_address)
+# python NEE1_collector.py simulate [stations] [sessions per station]
+if __name__ == "__main__":
+    mode = sys.argv[1]
+
+    if mode == "serve":
+        folder = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "collected")
+        run_server(folder, sys.argv[3] if len(sys.argv) > 3 else "127.0.0.1:8765")
+
+    elif mode == "simulate":
+        stations = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+        sessions = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+        result = simulate_stations(stations, sessions)
+        print(f"{result['trials']} trials from {stations} stations collected in {result['elapsed']:.2f} s: {result['stats']}")
+        print(f"{result['rejected_claims']} of {stations - 1} duplicate PID claims rejected")
+        print(f"send() cost: {result['send_cost']}")
+        for error in result["errors"]:
+            print(error)
+        if result["errors"] or result["rejected_claims"] != stations - 1:
+            sys.exit(1)
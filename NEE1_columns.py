@@ -0,0 +1,247 @@
+# Columnar binary copy of the trial data, for loading whole cohorts without parsing CSV
+# A store is a folder with one raw little-endian file per column (<column>.bin) and index.json, which holds the schema,
+# the number of rows and the sessions in it. Columns have fixed dtypes, text fields with a known set of values are
+# stored as int8 category codes (-1 when empty), so a store opens as numpy memmaps with no parsing or copying.
+# Sessions are appended by writing their bytes to the end of each column file, which is how a cohort store is built
+# from the per-session stores NEE1.py writes (data/<PID>_columns).
+import csv
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from NEE1_records import data_columns
+from NEE1_schedule import TENS_names, group_names, phases, trialtypes
+
+outcomes = ["high", "medium", "low"]
+
+# column: numpy dtype, or the categories of a categorical column. Missing values are NaN for floats, -1 for ints
+# (including "calibration" in blocknum) and category codes, and "" for text.
+column_kinds = {"phase": ["calibration"] + phases,
+                "trialtype": ["calibration"] + trialtypes,
+                "stimulus": ["TENS"],
+                "choice1": TENS_names,
+                "choice2": TENS_names,
+                "choicetrial": "?",
+                "rft_schedule": "<f8",
+                "outcome": outcomes,
+                "choice_response": TENS_names,
+                "choice_optimal": ["optimal", "suboptimal"],
+                "choice_rt": "<f8",
+                "exp_response": "<f8",
+                "exp_rt": "<f8",
+                "pain_response": "<f8",
+                "pain_rt": "<f8",
+                "TENS_edges": "<i2",
+                "TENS_jitter_mean": "<f8",
+                "TENS_jitter_max": "<f8",
+                "blocknum": "<i2",
+                "trialnum": "<i2",
+                "suboptimal_outcome": outcomes,
+                "datetime": "<U19",
+                "PID": "<U16",
+                "group": "<i1",
+                "group_name": group_names,
+                "cb": "<i1",
+                "optimalTENS_name": TENS_names,
+                "optimalTENS_pattern": ["pause", "constant"],
+                "shock_level_high": "<i1"}
+
+# the data file's columns (NEE1_records.data_columns) in the same order
+column_schema = {name: column_kinds[name] for name in data_columns}
+
+
+def is_missing(value):
+    return value is None or value == ""
+
+
+def encode_column(values, kind):
+    if isinstance(kind, list):
+        codes = []
+        for value in values:
+            if is_missing(value):
+                codes.append(-1)
+            elif value in kind:
+                codes.append(kind.index(value))
+            else:
+                raise ValueError(f"{value!r} is not one of the categories {kind}")
+        return np.array(codes, dtype="<i1")
+    dtype = np.dtype(kind)
+    if dtype.kind == "f":
+        return np.array([np.nan if is_missing(value) else float(value) for value in values], dtype=dtype)
+    if dtype.kind == "i":
+        encoded = []
+        for value in values:
+            try:
+                encoded.append(int(value))
+            except (TypeError, ValueError): # missing, or "calibration" in blocknum
+                encoded.append(-1)
+        return np.array(encoded, dtype=dtype)
+    if dtype.kind == "b":
+        return np.array([value in (True, "True") for value in values], dtype=dtype)
+    text = ["" if is_missing(value) else str(value) for value in values]
+    for value in text: # numpy would cut a longer value short without saying so
+        if len(value) > text_width(kind):
+            raise ValueError(f"{value!r} is longer than the {text_width(kind)} characters the column holds")
+    return np.array(text, dtype=dtype)
+
+
+# Characters a text column holds (e.g. 16 for "<U16")
+def text_width(kind):
+    return np.dtype(kind).itemsize // np.dtype("<U1").itemsize
+
+
+# Columns of values (e.g. NEE1_records.TrialStore.columns()) to a column: array dict
+def encode_columns(columns, schema=column_schema):
+    encoded = {}
+    for name, kind in schema.items():
+        try:
+            encoded[name] = encode_column(columns[name], kind)
+        except ValueError as error:
+            raise ValueError(f"column {name}: {error}") from None
+    return encoded
+
+
+# Trial rows read back from a data file (as strings) to a column: array dict
+def encode_rows(rows, schema=column_schema):
+    return encode_columns({name: [row.get(name) for row in rows] for name in schema}, schema)
+
+
+# Category codes back to text ("" for -1)
+def decode(codes, categories):
+    return np.asarray(list(categories) + [""], dtype=object)[codes]
+
+
+class ColumnStore:
+    def __init__(self, path, schema=column_schema):
+        self.path = path
+        self.index_path = os.path.join(path, "index.json")
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                self.index = json.load(index_file)
+            if self.index["schema"] != json.loads(json.dumps(schema)):
+                raise ValueError(f"{path} was written with a different column schema")
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.index = {"schema": schema, "rows": 0, "sessions": []}
+            self.save_index()
+        self.schema = self.index["schema"]
+
+    def dtype(self, name):
+        kind = self.schema[name]
+        return np.dtype("<i1" if isinstance(kind, list) else kind)
+
+    def column_path(self, name):
+        return os.path.join(self.path, name + ".bin")
+
+    def save_index(self):
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temp_path, self.index_path)
+
+    def append(self, columns, PID):
+        self.extend([(PID, columns)])
+
+    # Add sessions given as (PID, columns) pairs, with one write per column. Bytes past the indexed rows (left by an
+    # append that was cut off) are dropped first, and the index is only updated once every column is on disk.
+    def extend(self, sessions):
+        present = {session["PID"] for session in self.index["sessions"]}
+        added = []
+        start = self.index["rows"]
+        for PID, columns in sessions:
+            PID = str(PID)
+            if PID in present:
+                raise ValueError(f"session {PID} is already in {self.path}")
+            lengths = {len(columns[name]) for name in self.schema}
+            if len(lengths) != 1:
+                raise ValueError(f"columns of session {PID} have different lengths")
+            present.add(PID)
+            added.append({"PID": PID, "start": start, "rows": lengths.pop()})
+            start += added[-1]["rows"]
+        if not added:
+            return
+
+        for name in self.schema:
+            data = np.concatenate([np.asarray(columns[name], dtype=self.dtype(name)) for _, columns in sessions])
+            with open(self.column_path(name), "ab") as column_file:
+                column_file.truncate(self.index["rows"] * self.dtype(name).itemsize)
+                column_file.write(data.tobytes())
+                column_file.flush()
+                os.fsync(column_file.fileno())
+
+        self.index["sessions"] += added
+        self.index["rows"] = start
+        self.save_index()
+
+    # column: read-only memmap over the column file (no parsing, pages are read as they are used)
+    def columns(self, names=None):
+        columns = {}
+        for name in names or self.schema:
+            if self.index["rows"] == 0:
+                columns[name] = np.empty(0, dtype=self.dtype(name))
+            else:
+                columns[name] = np.memmap(self.column_path(name), dtype=self.dtype(name), mode="r", shape=(self.index["rows"],))
+        return columns
+
+    def session(self, PID):
+        for session in self.index["sessions"]:
+            if session["PID"] == str(PID):
+                return {name: column[session["start"]:session["start"] + session["rows"]]
+                        for name, column in self.columns().items()}
+        raise KeyError(PID)
+
+    def __len__(self):
+        return self.index["rows"]
+
+
+# One session's store, from its columns of values, replacing any earlier copy (e.g. from before the session was resumed)
+def write_session(path, columns, PID):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    ColumnStore(path).append(encode_columns(columns), PID)
+
+
+# Session stores or data files (<PID>_responses.csv) appended to a cohort store, skipping sessions already in it
+def append_sessions(cohort_path, sources):
+    cohort = ColumnStore(cohort_path)
+    present = {session["PID"] for session in cohort.index["sessions"]}
+    new_sessions = []
+    for source in sources:
+        if source.endswith(".csv"):
+            with open(source, newline="") as csv_file:
+                rows = list(csv.DictReader(csv_file))
+            sessions = [(rows[0]["PID"], encode_rows(rows))] if rows else []
+        else:
+            store = ColumnStore(source)
+            sessions = [(session["PID"], {name: np.array(column) for name, column in store.session(session["PID"]).items()})
+                        for session in store.index["sessions"]] # copied, so the source files are not left mapped
+        for PID, columns in sessions:
+            if PID not in present:
+                new_sessions.append((PID, columns))
+                present.add(PID)
+    cohort.extend(new_sessions)
+    return len(new_sessions)
+
+
+# python NEE1_columns.py append <cohort store> <session stores or data files ...>
+# python NEE1_columns.py load <store>
+if __name__ == "__main__":
+    mode = sys.argv[1]
+
+    if mode == "append":
+        start = time.perf_counter()
+        appended = append_sessions(sys.argv[2], sys.argv[3:])
+        print(f"appended {appended} sessions to {sys.argv[2]} in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    elif mode == "load":
+        start = time.perf_counter()
+        store = ColumnStore(sys.argv[2])
+        columns = store.columns()
+        opened = time.perf_counter()
+        pain_mean = np.nanmean(columns["pain_response"]) if len(store) else float("nan")
+        print(f"{len(store)} rows from {len(store.index['sessions'])} sessions opened in {(opened - start) * 1000:.2f} ms, "
+              f"mean pain rating {pain_mean:.1f} computed in {(time.perf_counter() - opened) * 1000:.2f} ms")
@@ -0,0 +1,145 @@
+# Timing-critical sections for NEE1
+# The countdown, TENS and shock phases of a trial run inside a critical section (CriticalSections.section). On entry
+# the stimuli the section draws are drawn once into the back buffer and cleared, so no texture or glyph is built on a
+# frame that counts. Then the garbage collector is switched off and the process priority raised (psychopy core.rush).
+# The priority is restored on the way out, even when the section is left by an exception or on escape. The collector
+# stays off until collect() at the start of the next ITI, where a pause costs nothing. Switched back on any earlier,
+# the first allocation after the section (on a rating frame) would pay for scanning everything the section made.
+# freeze() moves everything alive after startup (psychopy, the stimuli) out of the collector's reach, so the
+# collections left outside the sections only scan objects made since.
+# Every collection is timed through gc.callbacks and filed under where it ran (outside a section, inside one, or
+# deferred to the ITI or startup), so pause_report() shows whether any pauses are left in the critical phases.
+# The TENS pulse thread and the watchdogs (NEE1_watchdog.py) need the GIL to run, and a collection holds it. So no
+# collection inside a section also means none of them is held up by one while TENS or the shock is on. A deferred
+# collection in the ITI can hold them up, but the port is off by then. Raising the priority lifts all their threads
+# together.
+import contextlib
+import gc
+import sys
+import time
+
+from NEE1_timing import TimingStats
+
+
+class CriticalSections:
+    def __init__(self, win=None, rush=None):
+        self.win = win # stimuli are pre-drawn into its back buffer, which is then cleared
+        self.rush = rush # psychopy core.rush, or None to leave the priority alone
+        self.where = "outside" # which pauses list a collection running now goes to
+        self.pauses = {"outside": TimingStats(), "critical": TimingStats(), "deferred": TimingStats()}
+        self.sections = TimingStats() # how long each section ran
+        self.rushed = None # what rush() returned (False if the priority could not be raised)
+        self.frozen = 0 # objects moved out of the collector's reach by freeze()
+        self.deferred = False # the collector was switched off by a section and is waiting for collect()
+        self.collect_start = None
+        gc.callbacks.append(self._gc_callback)
+
+    # Run once the long-lived objects have been made (collects first so no garbage is frozen with them)
+    def freeze(self):
+        self.collect()
+        gc.freeze()
+        self.frozen = gc.get_freeze_count()
+
+    @contextlib.contextmanager
+    def section(self, stims=()):
+        if stims:
+            for stim in stims:
+                stim.draw()
+            self.win.clearBuffer()
+        if gc.isenabled():
+            self.deferred = True
+            gc.disable()
+        if self.rush is not None:
+            self.rushed = self.rush(True)
+        self.where = "critical"
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.sections.add(time.perf_counter() - start)
+            self.where = "outside"
+            if self.rush is not None:
+                self.rush(False)
+
+    # Collect the garbage left by the last section and switch the collector back on (called at the start of the ITI,
+    # or by freeze()); returns how long it took
+    def collect(self):
+        self.where = "deferred"
+        start = time.perf_counter()
+        try:
+            gc.collect()
+        finally:
+            self.where = "outside"
+        self.restore()
+        return time.perf_counter() - start
+
+    def restore(self):
+        if self.deferred:
+            self.deferred = False
+            gc.enable()
+
+    def _gc_callback(self, phase, info):
+        if phase == "start":
+            self.collect_start = time.perf_counter()
+        elif self.collect_start is not None:
+            self.pauses[self.where].add(time.perf_counter() - self.collect_start)
+            self.collect_start = None
+
+    def pause_report(self):
+        report = {where: pauses.summary() for where, pauses in self.pauses.items()}
+        report["sections"] = self.sections.summary()
+        report["rushed"] = self.rushed
+        report["frozen"] = self.frozen
+        return report
+
+    def close(self):
+        if self._gc_callback in gc.callbacks:
+            gc.callbacks.remove(self._gc_callback)
+        self.restore()
+        gc.unfreeze()
+
+
+# A render loop that makes cyclic garbage every frame (as the stimuli and event records do) over a heap of long-lived
+# objects (as psychopy and the stimuli are), run as the script ran before (collector on, nothing frozen) and then after
+# freeze() inside a critical section. Returns summaries of the real time per frame for each, and the pause report.
+def measure_pauses(frames=5000, heap_size=300000, garbage_per_frame=50):
+    heap = [{"index": i, "items": [i]} for i in range(heap_size)]
+    gc.collect() # the collection building the heap triggers is not part of the measurement
+    sections = CriticalSections()
+
+    def frame():
+        for i in range(garbage_per_frame):
+            node = {"frame": i}
+            node["self"] = node # a cycle, only freed by the collector
+
+    outside = TimingStats()
+    for _ in range(frames):
+        start = time.perf_counter()
+        frame()
+        outside.add(time.perf_counter() - start)
+
+    sections.freeze()
+    critical = TimingStats()
+    with sections.section():
+        for _ in range(frames):
+            start = time.perf_counter()
+            frame()
+            critical.add(time.perf_counter() - start)
+    sections.collect()
+    report = sections.pause_report()
+    sections.close()
+    del heap
+    return outside.summary(), critical.summary(), report
+
+
+# python NEE1_critical.py pauses  -> frame times with the collector on and inside a critical section
+if __name__ == "__main__":
+    mode = sys.argv[1]
+
+    if mode == "pauses":
+        outside, critical, report = measure_pauses()
+        for name, summary in (("collector on", outside), ("critical section", critical)):
+            print(f"{name:17s} frame p50 {summary['p50'] * 1e6:7.1f} us, p99 {summary['p99'] * 1e6:7.1f} us, max {summary['max'] * 1000:6.2f} ms")
+        for where in ("outside", "critical", "deferred"):
+            pauses = report[where]
+            print(f"collections {where:9s} {pauses['n']:5d}" + (f", max {pauses['max'] * 1000:.2f} ms" if pauses["n"] else ""))
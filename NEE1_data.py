@@ -0,0 +1,97 @@
+# Data saving helpers for NEE1
+import csv
+import json
+import os
+
+
+# Append-only CSV writer for trial data.
+# Rows (values in fieldnames order) go to <path>.partial as each trial completes; sync() pushes them to disk (call it at ITI boundaries) and
+# finalize() renames the file to its final name, so a crash loses at most the trial in progress.
+class TrialWriter:
+    def __init__(self, path, fieldnames):
+        self.path = path
+        self.partial_path = path + ".partial"
+        self.fieldnames = list(fieldnames)
+        self.finalized = False
+
+        write_header = not os.path.exists(self.partial_path) or os.path.getsize(self.partial_path) == 0
+        self.file = open(self.partial_path, mode="a", newline="")
+        self.writer = csv.writer(self.file)
+        if write_header:
+            self.writer.writerow(self.fieldnames)
+            self.sync()
+
+    def writerow(self, values):
+        self.writer.writerow(values)
+
+    def sync(self):
+        if self.finalized:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def finalize(self):
+        if self.finalized:
+            return
+        self.sync()
+        self.file.close()
+        os.replace(self.partial_path, self.path)
+        self.finalized = True
+        if hasattr(os, "O_DIRECTORY"): # make the rename itself durable
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+
+# Append-only session journal (<PID>_journal.jsonl), one JSON event per line:
+# the generated trial order, the calibrated shock levels, every saved trial (without the session constants, which
+# are in the session event and the plan) and the end of the session.
+# load_journal() rebuilds that state so an interrupted session can be resumed from the next trial; the journal is
+# synced before the data file, so the data file can always be rebuilt from its rows.
+class SessionJournal:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, mode="a")
+
+    def record(self, event, **fields):
+        fields["event"] = event
+        self.file.write(json.dumps(fields) + "\n")
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+
+def load_journal(path):
+    state = {"session": None, "trial_order": None, "shock_trig": None, "rows": [], "completed": {}, "finished": False}
+    with open(path) as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError: # last line cut off by the crash
+                break
+            event = entry.pop("event")
+            if event == "session":
+                state["session"] = entry
+            elif event == "trial_order":
+                state["trial_order"] = entry["trial_order"]
+            elif event == "calibrated":
+                state["shock_trig"] = entry["shock_trig"]
+            elif event == "trial":
+                state["rows"].append(entry["trial"])
+                if entry["trial"].get("trialnum") != None: # calibration trials are not numbered
+                    state["completed"][entry["trial"]["trialnum"]] = entry["trial"]
+            elif event == "finished":
+                state["finished"] = True
+
+    # completed trials carry the choices, outcomes and ratings made during the session
+    if state["trial_order"] is not None:
+        state["trial_order"] = [state["completed"].get(trial["trialnum"], trial) for trial in state["trial_order"]]
+    return state
@@ -0,0 +1,147 @@
+# Binary event log for NEE1
+# Every flip, port write, response and escape check is logged as a fixed 16-byte record (time, event code, value).
+# log() packs the record into a preallocated ring buffer with struct.pack_into, under a lock shared with the TENS pulse
+# thread. A background thread copies the filled part of the ring to <PID>_events.bin every flush_interval. If the
+# flusher falls behind and the ring fills up, new records are counted as dropped rather than overwriting unflushed ones.
+# The file is a flat array of records (event_dtype), so a whole session opens with numpy.memmap (load_events). The
+# codes are in <PID>_events.json next to it.
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+import NEE1_timing
+from NEE1_timing import TimingStats
+
+# code: what value holds
+event_codes = {"session": 1, # 1 started, 2 resumed, 0 finished
+               "trial": 2, # trial number (0 for calibration trials)
+               "flip": 3, # FlipRecorder.phases code of the trial phase, -1 outside the countdown/shock/rating
+               "port": 4, # byte written to the port
+               "escape_check": 5, # 1 when the main thread starts the exit after escape (see NEE1_watchdog.py)
+               "click": 6, # index of the button clicked, in the order the buttons were offered
+               "key": 7, # index of the key pressed in the keys accepted
+               "rating": 8} # slider rating x 10, on the frame the rating was made
+event_dtype = np.dtype([("time", "<f8"), ("code", "<u4"), ("value", "<i4")])
+record = struct.Struct("<dIi")
+
+
+class EventLog:
+    def __init__(self, path, capacity=65536, flush_interval=0.25, clock=None):
+        self.path = path
+        self.capacity = capacity # records held in memory between flushes
+        self.flush_interval = flush_interval
+        self.clock = clock or NEE1_timing.default_clock
+        self.ring = bytearray(capacity * record.size)
+        self.head = 0 # records logged
+        self.tail = 0 # records on disk
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="NEE1 event log", daemon=True)
+
+    def start(self):
+        with open(os.path.splitext(self.path)[0] + ".json", "w") as codes_file:
+            json.dump({"dtype": event_dtype.descr, "codes": event_codes}, codes_file)
+        self.file = open(self.path, mode="ab")
+        self.thread.start()
+        return self
+
+    def log(self, name, value=0):
+        self.log_code(event_codes[name], value)
+
+    def log_code(self, code, value):
+        now = self.clock.now()
+        with self.lock:
+            if self.head - self.tail >= self.capacity:
+                self.dropped += 1
+                return
+            record.pack_into(self.ring, (self.head % self.capacity) * record.size, now, code, value)
+            self.head += 1
+
+    # Function logging one kind of event, e.g. a PortState listener
+    def writer(self, name):
+        code = event_codes[name]
+        return lambda value: self.log_code(code, value)
+
+    # Copy the records logged since the last flush to the file (the slots are not reused until tail moves past them)
+    def flush(self):
+        with self.lock:
+            head = self.head
+        start, end = self.tail % self.capacity, head % self.capacity
+        if head - self.tail == 0:
+            return
+        if start < end:
+            self.file.write(self.ring[start * record.size:end * record.size])
+        else: # wrapped around the end of the ring
+            self.file.write(self.ring[start * record.size:])
+            self.file.write(self.ring[:end * record.size])
+        self.file.flush()
+        with self.lock:
+            self.tail = head
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def stats(self):
+        return {"logged": self.head, "dropped": self.dropped}
+
+
+# A session's events as a read-only record array (fields time, code and value)
+def load_events(path):
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=event_dtype)
+    return np.memmap(path, dtype=event_dtype, mode="r")
+
+
+# Cost of log() per call, with the flusher running (the ring holds every event, so none are dropped)
+def measure_cost(path, events=200000):
+    event_log = EventLog(path, capacity=events).start()
+    log_port = event_log.writer("port")
+    cost = TimingStats()
+    for i in range(events):
+        start = time.perf_counter()
+        log_port(i & 0xFF)
+        cost.add(time.perf_counter() - start)
+    event_log.close()
+    return cost.summary(), event_log.stats()
+
+
+# python NEE1_eventlog.py summary data/<PID>_events.bin   -> events per code and the spread of frame intervals
+# python NEE1_eventlog.py cost                            -> cost of logging one event
+if __name__ == "__main__":
+    mode = sys.argv[1]
+
+    if mode == "summary":
+        events = load_events(sys.argv[2])
+        names = {code: name for name, code in event_codes.items()}
+        print(f"{len(events)} events over {events['time'][-1] - events['time'][0]:.1f} s" if len(events) else "no events")
+        for code in np.unique(events["code"]):
+            print(f"  {names.get(int(code), code):12s} {int(np.sum(events['code'] == code))}")
+        flips = events["time"][events["code"] == event_codes["flip"]]
+        if len(flips) > 1:
+            intervals = np.diff(flips)
+            intervals = intervals[intervals < 0.1] # consecutive frames, not pauses between screens
+            print(f"frame intervals: median {np.median(intervals) * 1000:.2f} ms, 99th percentile "
+                  f"{np.percentile(intervals, 99) * 1000:.2f} ms, max {intervals.max() * 1000:.2f} ms")
+
+    elif mode == "cost":
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder:
+            summary, stats = measure_cost(os.path.join(folder, "events.bin"))
+        print(f"log() cost: p50 {summary['p50'] * 1e6:.2f} us, p99 {summary['p99'] * 1e6:.2f} us, "
+              f"max {summary['max'] * 1e6:.1f} us ({stats['logged']} logged, {stats['dropped']} dropped)")
@@ -0,0 +1,97 @@
+# Response input for NEE1
+# Mouse clicks and key presses are read once per frame from psychopy's timestamped event state instead of
+# busy-polling mouse.isPressedIn, and every response time counts from the flip that showed the response screen:
+# keys come from psychopy.hardware.keyboard (psychtoolbox timestamps where available), clicks from the mouse click
+# clocks and slider ratings from each slider's response clock, all reset on that flip.
+# The escape watcher (NEE1_watchdog.py) reads escape from the same keyboard, possibly from its own thread. psychopy
+# keeps one key buffer per device, so every keyboard call goes through one lock, and an escape press found when the
+# keys are cleared at a response onset is kept for escape_down() instead of being thrown away.
+import threading
+
+
+class ResponseEngine:
+    def __init__(self, win, mouse, keyboard):
+        self.win = win
+        self.mouse = mouse # event.Mouse
+        self.keyboard = keyboard # hardware.keyboard.Keyboard
+        self.held = False
+        self.lock = threading.Lock() # around every use of the keyboard
+        self.escape_pressed = False # escape seen while clearing the keys, not yet taken by escape_down()
+        self.listeners = [] # called with ("click", index of the region) or ("key", index in keyList) for every response
+
+    # Call right before the flip that shows a response screen; response times (and those of the sliders given) count from it
+    def onset(self, sliders=()):
+        self.win.callOnFlip(self._reset, sliders)
+
+    def _reset(self, sliders):
+        self.mouse.clickReset()
+        with self.lock:
+            if self.keyboard.getKeys(keyList=["escape"], waitRelease=False):
+                self.escape_pressed = True
+            self.keyboard.clock.reset()
+            self.keyboard.clearEvents()
+        for slider in sliders:
+            slider.responseClock.reset()
+        self.held = self.mouse.getPressed()[0] == 1 # a button still down from the previous screen is not a click
+
+    # (name, response time) of the region clicked with the left button, or None
+    def clicked(self, regions):
+        pressed, times = self.mouse.getPressed(getTime=True)
+        if not pressed[0]:
+            self.held = False
+            return None
+        if self.held:
+            return None
+        for index, (name, region) in enumerate(regions.items()):
+            if region.contains(self.mouse):
+                self._notify("click", index)
+                return name, times[0]
+        return None
+
+    # Wait for a click in one of the regions, redrawing stims every frame so the loop is paced by the flip instead of spinning
+    def wait_click(self, regions, stims=(), check=None):
+        while True:
+            if check != None:
+                check()
+            response = self.clicked(regions)
+            if response != None:
+                return response
+            self.redraw(stims)
+
+    # (name, response time) of every key in keyList pressed since onset and not yet read; other keys stay queued
+    def keys(self, keyList=None):
+        with self.lock:
+            keys = [(key.name, key.rt) for key in self.keyboard.getKeys(keyList=keyList, waitRelease=False)]
+        for name, _ in keys:
+            self._notify("key", keyList.index(name) if keyList else 0)
+        return keys
+
+    # True if escape was pressed since the last call (safe to call from another thread)
+    def escape_down(self):
+        with self.lock:
+            pressed = self.escape_pressed or bool(self.keyboard.getKeys(keyList=["escape"], waitRelease=False))
+            self.escape_pressed = False
+        return pressed
+
+    def _notify(self, kind, value):
+        for listener in self.listeners:
+            listener(kind, value)
+
+    def wait_keys(self, keyList=None, stims=(), check=None):
+        while True:
+            if check != None:
+                check()
+            keys = self.keys(keyList)
+            if keys:
+                return keys[0]
+            self.redraw(stims)
+
+    def redraw(self, stims):
+        for stim in stims:
+            stim.draw()
+        self.win.flip()
+
+    # time of the first rating made on a slider since onset (later adjustments do not count), or None
+    @staticmethod
+    def rating_rt(slider):
+        return slider.history[0][1] if slider.history else None
@@ -0,0 +1,184 @@
+# Parallel port backends for NEE1
+# Every backend has setData(value) like psychopy's ParallelPort and remembers the last value written.
+import csv
+import sys
+import threading
+
+import NEE1_timing
+from NEE1_timing import TimingStats
+
+
+# The real port (psychopy is only imported when hardware is used)
+class HardwarePort:
+    def __init__(self, address):
+        from psychopy import parallel
+        self.port = parallel.ParallelPort(address=address)
+        self.value = 0
+
+    def setData(self, value):
+        self.port.setData(value)
+        self.value = value
+
+
+# No port plugged in: writes are dropped
+class NullPort:
+    def __init__(self):
+        self.value = 0
+
+    def setData(self, value):
+        self.value = value
+
+
+# No port plugged in: every write is timestamped so trigger timing can be checked afterwards
+class RecordingPort:
+    def __init__(self, clock=None):
+        self.clock = clock or NEE1_timing.default_clock
+        self.times = []
+        self.values = []
+        self.value = 0
+
+    def setData(self, value):
+        self.times.append(self.clock.now())
+        self.values.append(value)
+        self.value = value
+
+    def writes(self):
+        return list(zip(self.times, self.values))
+
+    def save(self, path):
+        with open(path, mode="w", newline="") as port_file:
+            writer = csv.writer(port_file)
+            writer.writerow(["time", "value"])
+            writer.writerows(self.writes())
+
+
+# ports_live: True for the hardware port, "record" for a RecordingPort, None for no port
+def open_port(ports_live, address):
+    if ports_live == True:
+        return HardwarePort(address)
+    elif ports_live == "record":
+        return RecordingPort()
+    else:
+        return NullPort()
+
+
+# Owns the port byte as named bit-fields (e.g. {"TENS": 0x80, "shock": 0x7F}), so each channel can change without
+# clobbering the others. Updates are composed into the current byte under a lock (the TENS pulse thread and the main
+# thread both write) and a byte equal to the one already on the port is not written again.
+class PortState:
+    def __init__(self, port, fields):
+        self.port = port
+        self.fields = dict(fields) # name: bit mask
+        self.value = port.value
+        self.issued = 0 # writes sent to the port
+        self.coalesced = 0 # writes dropped because the byte would not change
+        self.blocked = 0 # writes dropped after shutdown(), or to a latched field
+        self.shut_down = False
+        self.latched = 0 # bits held low by latch() until release() or clear()
+        self.listeners = [] # called with every byte written (e.g. telemetry), from whichever thread wrote it
+        self.lock = threading.Lock()
+        masks = list(self.fields.values())
+        if any(a & b for i, a in enumerate(masks) for b in masks[i + 1:]):
+            raise ValueError(f"port fields overlap: {self.fields}")
+
+    # Set a field to a value counted from its lowest bit, e.g. set("shock", 12) or set("TENS", 1)
+    def set(self, name, value):
+        mask = self.fields[name]
+        shifted = value << ((mask & -mask).bit_length() - 1)
+        if shifted & ~mask:
+            raise ValueError(f"{value} does not fit in port field {name} (mask {mask:#04x})")
+        self.set_bits(name, shifted)
+
+    # Set a field from bits already in place, e.g. set_bits("TENS", 128); bits outside the field are ignored
+    def set_bits(self, name, bits):
+        mask = self.fields[name]
+        with self.lock:
+            self._write((self.value & ~mask) | (bits & mask))
+
+    # Function writing port bytes to one field, for the pulse engine
+    def writer(self, name):
+        return lambda bits: self.set_bits(name, bits)
+
+    # Whole byte (drop-in for port.setData)
+    def setData(self, value):
+        with self.lock:
+            self._write(value)
+
+    # Every pin low, written even if the byte is already 0 (and any latched fields released)
+    def clear(self):
+        with self.lock:
+            self.latched = 0
+            self._zero()
+
+    # Every pin low like clear(), with the fields named held low: writes that would set them (e.g. from a pulse thread
+    # that is still running) leave them at 0 until release() or clear() (stall watchdog; safe to call from any thread)
+    def latch(self, names):
+        with self.lock:
+            for name in names:
+                self.latched |= self.fields[name]
+            self._zero()
+
+    def release(self, names):
+        with self.lock:
+            for name in names:
+                self.latched &= ~self.fields[name]
+
+    # Every pin low, and nothing but clear() writes to the port again (escape; safe to call from any thread)
+    def shutdown(self):
+        with self.lock:
+            self.shut_down = True
+            self._zero()
+
+    def _zero(self):
+        self.port.setData(0)
+        self.value = 0
+        self.issued += 1
+        for listener in self.listeners:
+            listener(0)
+
+    def _write(self, value):
+        if self.shut_down:
+            self.blocked += 1
+            return
+        if value & self.latched:
+            self.blocked += 1
+            value &= ~self.latched
+            if value == self.value:
+                return
+        if value == self.value:
+            self.coalesced += 1
+            return
+        self.port.setData(value)
+        self.value = value
+        self.issued += 1
+        for listener in self.listeners:
+            listener(value)
+
+    def stats(self):
+        return {"issued": self.issued, "coalesced": self.coalesced, "blocked": self.blocked}
+
+
+# Latency of individual setData calls and overall write throughput
+def benchmark_port(port, writes=10000, clock=None):
+    clock = clock or NEE1_timing.default_clock
+    latency = TimingStats()
+    start = clock.now()
+    for i in range(writes):
+        before = clock.now()
+        port.setData(i & 1)
+        latency.add(clock.now() - before)
+    elapsed = clock.now() - start
+    port.setData(0)
+    return dict(latency.summary(), writes_per_second=writes / elapsed)
+
+
+# python NEE1_port.py [address]  -> benchmark each backend (the hardware port only if an address is given)
+if __name__ == "__main__":
+    backends = {"null": NullPort(), "record": RecordingPort(), "state": PortState(NullPort(), {"TENS": 0x80, "shock": 0x7F})}
+    if len(sys.argv) > 1:
+        backends["hardware"] = HardwarePort(int(sys.argv[1], 0))
+
+    for name, port in backends.items():
+        summary = benchmark_port(port)
+        print(f"{name:8s}: mean {summary['mean'] * 1e6:7.2f} us, p99 {summary['p99'] * 1e6:7.2f} us, "
+              f"max {summary['max'] * 1e6:8.2f} us, {summary['writes_per_second']:10.0f} writes/s")
@@ -0,0 +1,87 @@
+# Typed trial records for NEE1
+# The data file has one fixed list of columns (data_columns, in order). Trial holds the per-trial columns in __slots__,
+# so every calibration and main trial has the same fields and setting a field that is not a column fails straight
+# away. The session constants (PID, group, counterbalancing, start time) are not
+# copied into each trial. TrialStore keeps them once and adds them when a data row is built.
+from operator import attrgetter, itemgetter
+
+# Columns of the data file, in order (the columnar copy in NEE1_columns.py follows the same list)
+data_columns = ["phase", "trialtype", "stimulus", "choice1", "choice2", "choicetrial", "rft_schedule", "outcome",
+                "choice_response", "choice_optimal", "choice_rt", "exp_response", "exp_rt", "pain_response", "pain_rt",
+                "TENS_edges", "TENS_jitter_mean", "TENS_jitter_max", "blocknum", "trialnum", "suboptimal_outcome",
+                "datetime", "PID", "group", "group_name", "cb", "optimalTENS_name", "optimalTENS_pattern",
+                "shock_level_high"]
+session_fields = ["datetime", "PID", "group", "group_name", "cb", "optimalTENS_name", "optimalTENS_pattern"]
+trial_fields = [name for name in data_columns if name not in session_fields]
+
+
+class Trial:
+    __slots__ = trial_fields
+
+    # Fields not given are None (blank in the data file)
+    def __init__(self, **fields):
+        for name in trial_fields:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise KeyError(f"not trial fields: {sorted(fields)}")
+
+    # A row read back from a journal or data file, which may also hold the session constants
+    @classmethod
+    def from_row(cls, row):
+        return cls(**{name: value for name, value in row.items() if name not in session_fields})
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except (AttributeError, TypeError):
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        if name not in trial_field_index:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in trial_field_index else default
+
+    def keys(self):
+        return trial_fields
+
+    def values(self):
+        return trial_values(self)
+
+    def as_dict(self):
+        return dict(zip(trial_fields, trial_values(self)))
+
+
+trial_field_index = {name: i for i, name in enumerate(trial_fields)}
+trial_values = attrgetter(*trial_fields) # all the trial fields as a tuple, in one call
+
+
+# The trials saved in a session, each kept as a tuple of its field values when it is appended (so a trial repeated in
+# calibration keeps the values it had each time), with the session constants held once
+class TrialStore:
+    def __init__(self, constants):
+        self.constants = tuple(constants[name] for name in session_fields)
+        self.rows = []
+        # positions of the data columns in trial values + constants
+        self.data_row = itemgetter(*[trial_field_index[name] if name in trial_field_index
+                                     else len(trial_fields) + session_fields.index(name) for name in data_columns])
+
+    # Save a trial; returns its data file row (values in data_columns order)
+    def append(self, trial):
+        values = trial.values()
+        self.rows.append(values)
+        return self.data_row(values + self.constants)
+
+    def column(self, name):
+        if name in trial_field_index:
+            index = trial_field_index[name]
+            return [values[index] for values in self.rows]
+        return [self.constants[session_fields.index(name)]] * len(self.rows)
+
+    def columns(self):
+        return {name: self.column(name) for name in data_columns}
+
+    def __len__(self):
+        return len(self.rows)
@@ -0,0 +1,286 @@
+# Trial schedules and session plans for NEE1, generated for a whole cohort at once
+# Each participant's schedule is an int8 row of trial type codes; the block layout (phase, block number, reinforcement
+# schedule) is shared by every row. Shuffles come from a counter-based generator keyed on (seed, PID, attempt), so a
+# participant's schedule does not depend on who else is in the cohort and can be regenerated on its own.
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# Block structure, as run by NEE1.py
+num_blocks = {"conditioning": 10, "extinction": 10}
+block_trials = {"conditioning": {"TENS": 4, "control": 1},
+                "extinction": {"monopolar": 1, "bipolar": 1, "control": 1}}
+rft_schedule_blocks = {"consistent": {"conditioning": [1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+                                      "extinction": [1] * num_blocks["extinction"]},
+                       "change": {"conditioning": [1, 1, 0.75, 0.75, 0.5, 0.5, 0.25, 0.25, 0, 0],
+                                  "extinction": [1] * num_blocks["extinction"]}}
+
+TENS_names = ["monopolar", "bipolar"]
+shock_levels = 10 # calibration steps
+trialtypes = ["TENS", "control", "monopolar", "bipolar"] # trial type codes are indexes into this list
+phases = ["conditioning", "extinction"]
+group_names = ["consistent", "change"] # group 1 and group 2 in the data file
+
+
+def group_of(PIDs):
+    cb = np.asarray(PIDs, dtype=np.int64) % 4
+    return cb, np.where((cb == 0) | (cb == 2), 0, 1)
+
+
+# Counterbalancing for one participant: group, which TENS type is optimal, and which pulse pattern each type gets
+def counterbalance(PID):
+    cb = int(PID) % 4
+    group = 1 if cb in [0, 2] else 2
+    TENS_trialtypes = {"suboptimal": TENS_names[cb % 2],
+                       "optimal": TENS_names[(cb + 1) % 2]}
+    if (cb // 2) % 2 == 0:
+        TENS1_type, TENS2_type = "suboptimal", "optimal"
+    else:
+        TENS1_type, TENS2_type = "optimal", "suboptimal"
+    return {"cb": cb,
+            "group": group,
+            "group_name": group_names[group - 1],
+            "TENS_trialtypes": TENS_trialtypes,
+            "TENS1_name": TENS_trialtypes[TENS1_type], # shown on the right, gets the "pause" pattern
+            "TENS2_name": TENS_trialtypes[TENS2_type],
+            "TENS1_type": TENS1_type,
+            "TENS2_type": TENS2_type,
+            "TENS_pulse_patterns_names": {TENS1_type: "pause", TENS2_type: "constant"}}
+
+
+# Per-position layout shared by all participants: phase code, block index, NEE1 blocknum and, per group, the rft schedule
+def block_layout():
+    phase, block, blocknum, templates = [], [], [], []
+    rft = {name: [] for name in group_names}
+    for phase_code, phase_name in enumerate(phases):
+        template = [trialtypes.index(name) for name, num in block_trials[phase_name].items() for _ in range(num)]
+        for b in range(num_blocks[phase_name]):
+            templates.append(template)
+            for _ in template:
+                phase.append(phase_code)
+                block.append(len(templates) - 1)
+                blocknum.append((b // 2) + 1 if phase_name == "conditioning" else b)
+                for name in group_names:
+                    rft[name].append(rft_schedule_blocks[name][phase_name][b])
+
+    # blocks of the same length are shuffled and checked together: (block, slot) -> position, and each block's template
+    block_starts = np.flatnonzero(np.diff(np.array(block), prepend=-1))
+    same_length = []
+    for length in sorted({len(template) for template in templates}):
+        blocks = [b for b, template in enumerate(templates) if len(template) == length]
+        same_length.append((block_starts[blocks][:, None] + np.arange(length),
+                            np.array([templates[b] for b in blocks], dtype=np.int8)))
+
+    return {"phase": np.array(phase, dtype=np.int8),
+            "block": np.array(block, dtype=np.int16),
+            "blocknum": np.array(blocknum, dtype=np.int16),
+            "rft": np.array([rft[name] for name in group_names], dtype=np.float64), # (group, position)
+            "templates": templates,
+            "same_length": same_length}
+
+
+# splitmix64 finaliser, applied elementwise to uint64 arrays (wraps on overflow)
+def mix64(x):
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+# Random uint64 keys, shape (len(PIDs), n): the stream for each participant is fixed by (seed, stream, PID, attempt)
+def random_keys(seed, PIDs, attempts, n, stream=0):
+    golden = np.uint64(0x9E3779B97F4A7C15)
+    base = mix64(np.full(1, seed, dtype=np.uint64) * golden + np.uint64(stream)) # arrays wrap silently, scalars warn
+    base = mix64(base + np.asarray(PIDs, dtype=np.uint64) * golden)
+    base = mix64(base + np.asarray(attempts, dtype=np.uint64))
+    return mix64(base[:, None] + np.arange(1, n + 1, dtype=np.uint64) * golden)
+
+
+# Same streams as uniform floats in [0, 1)
+def random_uniform(seed, PIDs, attempts, n, stream=0):
+    return (random_keys(seed, PIDs, attempts, n, stream) >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+# Shuffle every block of every participant's schedule. Blocks are short, so each template slot is sent to the rank of
+# its key within the block (pairwise comparisons), which is faster than argsorting many tiny rows.
+def shuffle_blocks(layout, seed, PIDs, attempts):
+    keys = random_keys(seed, PIDs, attempts, len(layout["phase"]))
+    types = np.empty(keys.shape, dtype=np.int8)
+    for positions, templates in layout["same_length"]: # (blocks, length)
+        block_keys = keys[:, positions] # (participants, blocks, length)
+        ranks = (block_keys[..., None, :] < block_keys[..., :, None]).sum(axis=3)
+        shuffled = np.empty(block_keys.shape, dtype=np.int8)
+        np.put_along_axis(shuffled, ranks, np.broadcast_to(templates, ranks.shape), axis=2)
+        types[:, positions] = shuffled
+    return types
+
+
+# Extra conditions on a trial order, on top of the shuffle within each block. Every constraint rejects orders the plain
+# shuffle would have run, so it changes the randomisation: all are off by default (schedule_max_run in NEE1.py).
+# Block counts and reinforcement balance need no check, as trials are only ever shuffled within their block.
+class ScheduleConstraints:
+    def __init__(self, max_run=None):
+        self.max_run = max_run # most trials of the same type in a row (None for no limit)
+
+    # As recorded in each plan
+    def as_dict(self):
+        return {"max_run": self.max_run}
+
+    # Boolean mask of participants whose schedule breaks a constraint
+    def violations(self, types):
+        bad = np.zeros(len(types), dtype=bool)
+        if self.max_run is not None and types.shape[1] > self.max_run:
+            run = np.ones((len(types), types.shape[1] - self.max_run), dtype=bool)
+            for offset in range(1, self.max_run + 1):
+                run &= types[:, offset:types.shape[1] - self.max_run + offset] == types[:, :types.shape[1] - self.max_run]
+            bad |= run.any(axis=1)
+        return bad
+
+
+# Schedules for a cohort in one array-backed table
+class CohortSchedule:
+    def __init__(self, PIDs, seed=0, constraints=None, max_attempts=1000):
+        self.PIDs = np.asarray(PIDs, dtype=np.int64)
+        self.seed = seed
+        self.constraints = constraints or ScheduleConstraints()
+        self.layout = block_layout()
+        self.cb, self.groups = group_of(self.PIDs)
+        self.attempts = np.zeros(len(self.PIDs), dtype=np.int64)
+        self.types = shuffle_blocks(self.layout, seed, self.PIDs, self.attempts)
+
+        # reject and redraw only the participants whose schedules break a constraint
+        bad = self.constraints.violations(self.types)
+        while bad.any():
+            if self.attempts[bad].max() >= max_attempts:
+                raise ValueError(f"no valid schedule within {max_attempts} attempts for PIDs {self.PIDs[bad][:10].tolist()}")
+            self.attempts[bad] += 1
+            self.types[bad] = shuffle_blocks(self.layout, seed, self.PIDs[bad], self.attempts[bad])
+            still_bad = self.constraints.violations(self.types[bad])
+            bad[bad] = still_bad
+
+    def __len__(self):
+        return len(self.PIDs)
+
+    def rft(self):
+        return self.layout["rft"][self.groups]
+
+    # One participant's schedule as NEE1.py trial dicts (TENS choice names come from the participant's counterbalancing)
+    def trials(self, i, TENS_trialtypes):
+        layout = self.layout
+        trial_order = []
+        for position, code in enumerate(self.types[i]):
+            trialtype = trialtypes[code]
+            choicetrial = trialtype == "TENS"
+            trial_order.append({
+                "phase": phases[layout["phase"][position]],
+                "trialtype": None if choicetrial else trialtype,
+                "stimulus": None if trialtype == "control" else "TENS",
+                "choice1": TENS_trialtypes["optimal"] if choicetrial else None,
+                "choice2": TENS_trialtypes["suboptimal"] if choicetrial else None,
+                "choicetrial": choicetrial,
+                "rft_schedule": float(layout["rft"][self.groups[i], position]),
+                "outcome": None if choicetrial else "low",
+                "choice_response": None,
+                "choice_optimal": None,
+                "choice_rt": None,
+                "exp_response": None,
+                "exp_rt": None,
+                "pain_response": None,
+                "pain_rt": None,
+                "TENS_edges": None,
+                "TENS_jitter_mean": None,
+                "TENS_jitter_max": None,
+                "blocknum": int(layout["blocknum"][position]),
+                "trialnum": position + 1})
+        return trial_order
+
+
+# Ready-to-run session plans: counterbalancing, the calibration and main trial orders, and for every choice trial the
+# outcome a suboptimal choice will get (drawn here instead of at the choice, from an independent stream)
+def session_plans(PIDs, seed=0, constraints=None):
+    schedule = CohortSchedule(PIDs, seed=seed, constraints=constraints)
+    rft = schedule.rft()
+    suboptimal_high = random_uniform(seed, schedule.PIDs, schedule.attempts, rft.shape[1], stream=1) < rft
+    plans = []
+    for i, PID in enumerate(schedule.PIDs):
+        plan = {"PID": str(PID), "seed": seed, "constraints": schedule.constraints.as_dict(), "attempt": int(schedule.attempts[i])}
+        plan.update(counterbalance(PID))
+        plan["calib_trial_order"] = [{"phase": "calibration",
+                                      "blocknum": "calibration",
+                                      "stimulus": None,
+                                      "choicetrial": False,
+                                      "choice1": None,
+                                      "choice2": None,
+                                      "outcome": "high",
+                                      "trialtype": "calibration",
+                                      "pain_response": None,
+                                      "pain_rt": None} for _ in range(shock_levels)]
+        plan["trial_order"] = schedule.trials(i, plan["TENS_trialtypes"])
+        for trial, high in zip(plan["trial_order"], suboptimal_high[i]):
+            trial["suboptimal_outcome"] = ("high" if high else "low") if trial["choicetrial"] else None
+        plans.append(plan)
+    return plans
+
+
+def session_plan(PID, seed=0, constraints=None):
+    return session_plans([int(PID)], seed, constraints)[0]
+
+
+def plan_path(folder, PID):
+    return os.path.join(folder, f"{PID}_plan.json")
+
+
+def write_plans(PIDs, folder, seed=0, constraints=None):
+    os.makedirs(folder, exist_ok=True)
+    for plan in session_plans(PIDs, seed, constraints):
+        with open(plan_path(folder, plan["PID"]), mode="w") as plan_file:
+            json.dump(plan, plan_file, indent=1)
+
+
+def load_plan(path):
+    with open(path) as plan_file:
+        return json.load(plan_file)
+
+
+# What a plan file disagrees with the session about to run it on (empty if it was made for it): a copied or renamed
+# file, or a plan drawn with another seed or other constraints, would otherwise run the wrong order
+def plan_mismatches(plan, PID, seed, constraints):
+    expected = {"PID": str(int(PID)), "seed": seed, "constraints": constraints.as_dict()}
+    return [f"{name} is {plan.get(name)!r}, not {value!r}" for name, value in expected.items() if plan.get(name) != value]
+
+
+# python NEE1_schedule.py check [participants] [seed] [max run]     -> generate and check schedules for PIDs 1..participants
+# python NEE1_schedule.py plans <first PID> <last PID> [seed] [max run] -> write plans/<PID>_plan.json for NEE1.py to load
+# (seed and max run must match schedule_seed and schedule_max_run in NEE1.py, which checks them before running a plan)
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "check"
+
+    if mode == "check":
+        participants = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+        seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        constraints = ScheduleConstraints(int(sys.argv[4]) if len(sys.argv) > 4 else None)
+        PIDs = np.arange(1, participants + 1)
+        layout = block_layout()
+
+        start = time.perf_counter()
+        candidates = shuffle_blocks(layout, seed, PIDs, np.zeros(participants, dtype=np.int64))
+        drawn = time.perf_counter()
+        bad = constraints.violations(candidates)
+        checked = time.perf_counter()
+        print(f"{participants} candidate schedules drawn in {(drawn - start) * 1000:.1f} ms, "
+              f"checked in {(checked - drawn) * 1000:.1f} ms, {int(bad.sum())} rejected")
+
+        start = time.perf_counter()
+        schedule = CohortSchedule(PIDs, seed=seed, constraints=constraints)
+        print(f"{participants} valid schedules in {(time.perf_counter() - start) * 1000:.1f} ms, "
+              f"{int(schedule.attempts.sum())} redraws, at most {int(schedule.attempts.max())} for one participant")
+
+    elif mode == "plans":
+        first_PID, last_PID = int(sys.argv[2]), int(sys.argv[3])
+        seed = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+        constraints = ScheduleConstraints(int(sys.argv[5]) if len(sys.argv) > 5 else None)
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plans")
+        write_plans(range(first_PID, last_PID + 1), folder, seed, constraints)
+        print(f"wrote plans for PIDs {first_PID}-{last_PID} to {folder}")
@@ -0,0 +1,534 @@
+# Headless simulation of NEE1.py
+# Runs the real experiment script with no window and no hardware: psychopy is replaced by stand-in modules driven by a
+# virtual clock (waits and flips jump the clock instead of taking time), and a synthetic participant clicks the choice
+# buttons, works through calibration and gives slider ratings from a configurable response model.
+# Used to check counterbalancing and the data file schema over many sessions before a study goes live.
+import ast
+import contextlib
+import csv
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from collections import Counter
+
+import NEE1_timing
+from NEE1_timing import TimingStats, VirtualClock
+
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "NEE1.py")
+
+
+class SimulationError(Exception):
+    pass
+
+
+# How the synthetic participant behaves. All ratings are on the 0-100 slider scale, times are in seconds.
+class ResponseModel:
+    def __init__(self,
+                 p_optimal=0.7, # chance of choosing the optimal TENS type on choice trials
+                 tolerance_levels=(3, 8), # calibration stops at a level drawn from this range
+                 calibration_rating_per_level=8,
+                 pain_means={"high": 70, "medium": 50, "low": 30},
+                 expectancy_mean=50,
+                 rating_sd=10,
+                 choice_rt=(1.2, 0.4), # mean, sd
+                 rating_rt=(1.5, 0.5),
+                 key_rt=(2.0, 1.0),
+                 escape_time=None): # press escape this many (virtual) seconds into the session
+        self.p_optimal = p_optimal
+        self.tolerance_levels = tolerance_levels
+        self.calibration_rating_per_level = calibration_rating_per_level
+        self.pain_means = pain_means
+        self.expectancy_mean = expectancy_mean
+        self.rating_sd = rating_sd
+        self.choice_rt = choice_rt
+        self.rating_rt = rating_rt
+        self.key_rt = key_rt
+        self.escape_time = escape_time
+
+    def rt(self, kind, rng):
+        mean, sd = getattr(self, kind)
+        return max(0.15, rng.gauss(mean, sd))
+
+    def rating(self, mean, rng):
+        return round(min(100, max(0, rng.gauss(mean, self.rating_sd))), 1)
+
+
+# Plays the participant: looks at every flipped frame and decides what to click, rate or press
+class Participant:
+    def __init__(self, clock, model, rng, session_globals):
+        self.clock = clock
+        self.model = model
+        self.rng = rng
+        self.session = session_globals # the running script's globals (TENS_trialtypes, shock_trig, ...)
+        self.tolerance = rng.randint(*model.tolerance_levels)
+        self.shock_level = 0 # last shock byte sent to the port
+        self.click_target = None
+        self.click_time = None
+        self.key_time = None
+        self.rating_times = {}
+
+    # label texts of the buttons in a frame, mapped to the Rect drawn at the same position
+    def buttons(self, frame):
+        rects = {stim.pos: stim for stim in frame if isinstance(stim, Rect)}
+        return {stim.text: rects[stim.pos] for stim in frame if isinstance(stim, TextStim) and stim.pos in rects}
+
+    def on_flip(self, frame, rects, sliders):
+        now = self.clock.now()
+        if not rects: # the button screen is gone, so the mouse button has been let go
+            self.click_target = None
+        elif self.click_target is None:
+            buttons = self.buttons(frame)
+            if buttons:
+                label = self.choose(buttons)
+                self.click_target = buttons[label]
+                self.click_time = now + self.model.rt("choice_rt", self.rng)
+
+        for stim in sliders:
+            if stim.rating is None:
+                if stim not in self.rating_times:
+                    self.rating_times[stim] = now + self.model.rt("rating_rt", self.rng)
+                elif now >= self.rating_times[stim]:
+                    del self.rating_times[stim]
+                    stim.recordRating(self.rate(stim, frame))
+
+    def choose(self, buttons):
+        TENS_trialtypes = self.session["TENS_trialtypes"]
+        if TENS_trialtypes["optimal"] in buttons:
+            return TENS_trialtypes["optimal"] if self.rng.random() < self.model.p_optimal else TENS_trialtypes["suboptimal"]
+        if "Yes" in buttons: # try the previous level again?
+            return "No"
+        level = self.session["shock_trig"]["high"]
+        labels = {text.split()[0]: text for text in buttons} # "Try ...", "Stay ...", "Set ..."
+        if level < self.tolerance and "Try" in labels:
+            return labels["Try"]
+        if level > self.tolerance and "Set" in labels:
+            return labels["Set"]
+        return labels["Stay"]
+
+    def rate(self, slider, frame):
+        prompts = " ".join(stim.text for stim in frame if isinstance(stim, TextStim))
+        if slider.labels == (1, 5, 10): # calibration scale
+            return self.model.rating(self.session["shock_trig"]["high"] * self.model.calibration_rating_per_level, self.rng)
+        if "expect" in prompts:
+            return self.model.rating(self.model.expectancy_mean, self.rng)
+        outcome = {value: name for name, value in self.session["shock_trig"].items()}.get(self.shock_level, "high")
+        return self.model.rating(self.model.pain_means[outcome], self.rng)
+
+    # the button held down and when it was pressed, or (None, None) before the participant has clicked
+    def press(self):
+        if self.click_target is not None and self.clock.now() >= self.click_time:
+            return self.click_target, self.click_time
+        return None, None
+
+    def keys(self, keyList):
+        now = self.clock.now()
+        if self.model.escape_time is not None and now >= self.model.escape_time:
+            if keyList is None or "escape" in keyList:
+                self.model.escape_time = None
+                return ["escape"]
+        if keyList == ["escape"]: # only checking for escape, not waiting for a response
+            return []
+        if self.key_time is None:
+            self.key_time = now + self.model.rt("key_rt", self.rng)
+        if now >= self.key_time:
+            self.key_time = None
+            return [keyList[0] if keyList else "space"]
+        return []
+
+    def wait_keys(self, keyList):
+        self.clock.sleep(self.model.rt("key_rt", self.rng))
+        return [keyList[0] if keyList else "space"]
+
+
+# Stand-ins for the psychopy objects NEE1.py uses
+class Stim:
+    def __init__(self, win, **kwargs):
+        self.win = win
+        self.pos = (0, 0)
+        self.text = ""
+        self.__dict__.update(kwargs)
+        if isinstance(self.pos, list):
+            self.pos = tuple(self.pos)
+
+    def draw(self):
+        self.win.drawn.append(self)
+
+
+class TextStim(Stim):
+    pass
+
+
+class ImageStim(Stim):
+    pass
+
+
+class Rect(Stim):
+    def draw(self):
+        self.win.drawn.append(self)
+        self.win.rects += 1
+
+    def contains(self, point):
+        pos = point.getPos() if isinstance(point, Mouse) else point
+        return pos is not None and tuple(pos) == self.pos
+
+
+class Slider(Stim):
+    def __init__(self, win, **kwargs):
+        super().__init__(win, **kwargs)
+        self.marker = types.SimpleNamespace(size=None, color=None)
+        self.validArea = types.SimpleNamespace(size=None)
+        self.responseClock = Clock(win.sim.clock)
+        self.rating = None
+        self.history = []
+
+    def draw(self):
+        self.win.drawn.append(self)
+        self.win.sliders.append(self)
+
+    def getRating(self):
+        return self.rating
+
+    def recordRating(self, rating):
+        self.rating = rating
+        self.history.append((rating, self.responseClock.getTime()))
+
+    def reset(self):
+        self.rating = None
+        self.history = []
+        self.responseClock.reset()
+
+
+class Window:
+    def __init__(self, sim, **kwargs):
+        self.sim = sim
+        self.monitorFramePeriod = sim.frame_period
+        self.drawn = []
+        self.rects = 0
+        self.sliders = []
+        self.on_flip = []
+        self.closed = False
+        self.returned = None # real time the last flip returned
+
+    def flip(self, clearBuffer=True):
+        if self.returned is not None: # real time the script spent between flips
+            self.sim.frame_costs.add(time.perf_counter() - self.returned)
+        now = self.sim.clock.advance(self.sim.frame_period)
+        if now > self.sim.time_limit:
+            raise SimulationError(f"session still running after {self.sim.time_limit} simulated seconds")
+        self.sim.participant.on_flip(self.drawn, self.rects, self.sliders)
+        if clearBuffer:
+            self.clearBuffer()
+        on_flip, self.on_flip = self.on_flip, []
+        for function, args, kwargs in on_flip:
+            function(*args, **kwargs)
+        self.returned = time.perf_counter()
+        return now
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self.on_flip.append((function, args, kwargs))
+
+    def clearBuffer(self):
+        self.drawn = []
+        self.rects = 0
+        self.sliders = []
+
+    def close(self):
+        self.closed = True
+
+
+class ParallelPort:
+    def __init__(self, sim, address=None):
+        self.sim = sim
+
+    def setData(self, value):
+        self.sim.port_writes.append((self.sim.clock.now(), value))
+        if value & 0x7F: # shock level bits, whatever the TENS pin is doing
+            self.sim.participant.shock_level = value & 0x7F
+
+
+class Mouse:
+    def __init__(self, sim):
+        self.sim = sim
+        self.reset_time = sim.clock.now()
+
+    def getPressed(self, getTime=False):
+        target, press_time = self.sim.participant.press()
+        pressed = [0 if target is None else 1, 0, 0]
+        if getTime:
+            return pressed, [0 if target is None else press_time - self.reset_time, 0, 0]
+        return pressed
+
+    def getPos(self):
+        target = self.sim.participant.press()[0]
+        return None if target is None else target.pos
+
+    def isPressedIn(self, shape, buttons=None):
+        return shape.contains(self)
+
+    def clickReset(self):
+        self.reset_time = self.sim.clock.now()
+
+
+class Clock:
+    def __init__(self, clock):
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        self.start = self.clock.now()
+
+    def getTime(self):
+        return self.clock.now() - self.start
+
+
+class KeyPress:
+    def __init__(self, name, rt):
+        self.name = name
+        self.rt = rt
+
+
+class Keyboard:
+    def __init__(self, sim):
+        self.sim = sim
+        self.clock = Clock(sim.clock)
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        return [KeyPress(name, self.clock.getTime()) for name in self.sim.participant.keys(keyList)]
+
+    def clearEvents(self, eventType=None):
+        pass
+
+
+class CountdownTimer:
+    def __init__(self, clock, start=0):
+        self.clock = clock
+        self.start = start
+        self.started = clock.now()
+
+    def getTime(self):
+        return self.start - (self.clock.now() - self.started)
+
+
+class SessionQuit(SystemExit):
+    pass
+
+
+# One simulated session: the fake psychopy package, the virtual clock and the participant
+class SimulatedSession:
+    def __init__(self, PID, data_root, model=None, seed=None, frame_rate=60, time_limit=4 * 3600, resume=False):
+        self.PID = str(PID)
+        self.resume = resume # answer to the resume prompt if the PID has an interrupted session
+        self.data_root = data_root
+        self.model = model or ResponseModel()
+        self.seed = seed if seed is not None else int(PID)
+        self.frame_period = 1 / frame_rate
+        self.time_limit = time_limit
+        self.clock = VirtualClock()
+        self.port_writes = []
+        self.frame_costs = TimingStats()
+        self.globals = {}
+        self.participant = Participant(self.clock, self.model, random.Random(self.seed), self.globals)
+        self.PID_prompts = 0
+
+    # the experimenter at the console
+    def input(self, prompt=""):
+        if "Resume" in prompt:
+            return "y" if self.resume else "n"
+        self.PID_prompts += 1
+        if self.PID_prompts > 1:
+            raise SimulationError(f"participant ID {self.PID} was rejected")
+        return self.PID
+
+    def psychopy_modules(self):
+        sim = self
+        psychopy = types.ModuleType("psychopy")
+
+        core = types.ModuleType("psychopy.core")
+        core.getTime = self.clock.now
+        core.CountdownTimer = lambda start=0: CountdownTimer(sim.clock, start)
+        core.Clock = lambda: Clock(sim.clock)
+        core.wait = self.clock.sleep
+        core.rush = lambda enable=True, realtime=False: True
+        def quit():
+            raise SessionQuit()
+        core.quit = quit
+
+        event = types.ModuleType("psychopy.event")
+        event.getKeys = lambda keyList=None, **kwargs: sim.participant.keys(keyList)
+        event.waitKeys = lambda keyList=None, **kwargs: sim.participant.wait_keys(keyList)
+        event.Mouse = lambda *args, **kwargs: Mouse(sim)
+
+        visual = types.ModuleType("psychopy.visual")
+        visual.Window = lambda *args, **kwargs: Window(sim, **kwargs)
+        visual.TextStim = TextStim
+        visual.ImageStim = ImageStim
+        visual.Rect = Rect
+        visual.Slider = Slider
+
+        parallel = types.ModuleType("psychopy.parallel")
+        parallel.ParallelPort = lambda address=None: ParallelPort(sim, address)
+
+        hardware = types.ModuleType("psychopy.hardware")
+        keyboard = types.ModuleType("psychopy.hardware.keyboard")
+        keyboard.Keyboard = lambda *args, **kwargs: Keyboard(sim)
+
+        gui = types.ModuleType("psychopy.gui")
+        prefs = types.ModuleType("psychopy.prefs")
+
+        modules = {"psychopy": psychopy, "psychopy.core": core, "psychopy.event": event, "psychopy.visual": visual,
+                   "psychopy.parallel": parallel, "psychopy.hardware": hardware, "psychopy.hardware.keyboard": keyboard,
+                   "psychopy.gui": gui, "psychopy.prefs": prefs}
+        for name, module in modules.items():
+            if name != "psychopy":
+                package, _, attribute = name.rpartition(".")
+                setattr(modules[package], attribute, module)
+
+        # Pillow (installed with psychopy) decodes the stimulus images at startup; the fake stimuli never look at them
+        PIL = types.ModuleType("PIL")
+        PIL.Image = types.ModuleType("PIL.Image")
+        PIL.Image.open = lambda path: types.SimpleNamespace(filename=path, load=lambda: None)
+        modules.update({"PIL": PIL, "PIL.Image": PIL.Image})
+        return modules
+
+    def run(self, code):
+        modules = self.psychopy_modules()
+        saved_modules = {name: sys.modules.get(name) for name in modules}
+        saved_clock = NEE1_timing.default_clock
+        sys.modules.update(modules)
+        NEE1_timing.default_clock = self.clock
+        random.seed(self.seed)
+
+        self.globals.update({"__name__": "__main__",
+                             "__file__": os.path.join(self.data_root, "NEE1.py"), # data/ is created next to this path
+                             "input": self.input})
+        self.quit = False
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                exec(code, self.globals)
+        except SessionQuit:
+            self.quit = True
+        finally:
+            self.output = output.getvalue()
+            self.elapsed = time.perf_counter() - start
+            NEE1_timing.default_clock = saved_clock
+            for name, module in saved_modules.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+        return self.result()
+
+    def result(self):
+        g = self.globals
+        csv_filepath = g["csv_filepath"]
+        with open(csv_filepath, newline="") as csv_file:
+            reader = csv.DictReader(csv_file)
+            rows = list(reader)
+            columns = reader.fieldnames
+        return {"PID": self.PID,
+                "cb": g["cb"],
+                "group_name": g["group_name"],
+                "optimalTENS_name": g["TENS_trialtypes"]["optimal"],
+                "optimalTENS_pattern": g["TENS_pulse_patterns_names"]["optimal"],
+                "shock_level_high": g["shock_trig"]["high"],
+                "quit": self.quit,
+                "columns": columns,
+                "rows": rows,
+                "virtual_duration": self.clock.now(),
+                "elapsed": self.elapsed,
+                "port_writes": len(self.port_writes)}
+
+
+# Compile NEE1.py, replacing the values of top-level settings such as flip_timing = False with those in settings
+def load_script(settings=None):
+    with open(script_path) as script_file:
+        tree = ast.parse(script_file.read(), script_path)
+    for statement in tree.body:
+        if (settings and isinstance(statement, ast.Assign) and len(statement.targets) == 1
+                and isinstance(statement.targets[0], ast.Name) and statement.targets[0].id in settings):
+            statement.value = ast.copy_location(ast.Constant(settings[statement.targets[0].id]), statement.value)
+    return compile(tree, script_path, "exec")
+
+
+# Values of top-level settings in NEE1.py (e.g. timer_precision_range), evaluated in order so later settings can use
+# earlier ones, without running the script
+def script_settings(names):
+    with open(script_path) as script_file:
+        tree = ast.parse(script_file.read(), script_path)
+    settings = {}
+    for statement in tree.body:
+        if (isinstance(statement, ast.Assign) and len(statement.targets) == 1
+                and isinstance(statement.targets[0], ast.Name) and statement.targets[0].id in names):
+            expression = ast.Expression(statement.value)
+            settings[statement.targets[0].id] = eval(compile(expression, script_path, "eval"), {}, dict(settings))
+    return settings
+
+
+def simulate_session(PID, data_root, model=None, seed=None, frame_rate=60, code=None, resume=False, settings=None):
+    return SimulatedSession(PID, data_root, model, seed, frame_rate, resume=resume).run(code or load_script(settings))
+
+
+# Problems with one session's data file (empty list if it looks right)
+def check_session(result):
+    problems = []
+    expected_columns = set(result["columns"] or [])
+    main_rows = [row for row in result["rows"] if row["phase"] != "calibration"]
+    calib_rows = [row for row in result["rows"] if row["phase"] == "calibration"]
+    if not result["quit"]:
+        if not calib_rows:
+            problems.append("no calibration rows")
+        if not main_rows:
+            problems.append("no main trial rows")
+        if [int(row["trialnum"]) for row in main_rows] != list(range(1, len(main_rows) + 1)):
+            problems.append("main trials missing or out of order")
+    for row in result["rows"]:
+        if set(row) != expected_columns or None in row.values():
+            problems.append(f"row with unexpected fields: {sorted(row)}")
+            break
+    for row in main_rows:
+        if row["pain_response"] == "":
+            problems.append(f"trial {row['trialnum']} has no pain rating")
+        if row["choicetrial"] == "True" and row["choice_optimal"] not in ("optimal", "suboptimal"):
+            problems.append(f"choice trial {row['trialnum']} has no choice")
+    return problems
+
+
+# Summary of many sessions: counterbalancing cells, data file schemas and simulation speed
+def simulate_cohort(PIDs, data_root=None, model=None, frame_rate=60, settings=None):
+    code = load_script(settings)
+    with tempfile.TemporaryDirectory() as temp_root:
+        results = [simulate_session(PID, data_root or temp_root, model, frame_rate=frame_rate, code=code) for PID in PIDs]
+
+    cells = Counter((r["cb"], r["group_name"], r["optimalTENS_name"], r["optimalTENS_pattern"]) for r in results)
+    schemas = Counter(tuple(r["columns"]) for r in results)
+    problems = {r["PID"]: check_session(r) for r in results}
+    return {"sessions": len(results),
+            "cells": cells,
+            "schemas": schemas,
+            "problems": {PID: p for PID, p in problems.items() if p},
+            "mean_elapsed": sum(r["elapsed"] for r in results) / len(results),
+            "mean_virtual_duration": sum(r["virtual_duration"] for r in results) / len(results),
+            "results": results}
+
+
+# python NEE1_simulate.py [sessions] [first PID]
+if __name__ == "__main__":
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    first_PID = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    summary = simulate_cohort(range(first_PID, first_PID + sessions))
+
+    print(f"{summary['sessions']} sessions, {summary['mean_virtual_duration'] / 60:.1f} simulated minutes each, "
+          f"{summary['mean_elapsed'] * 1000:.0f} ms real time each")
+    print("counterbalancing cells (cb, group, optimal TENS, optimal pattern):")
+    for cell, count in sorted(summary["cells"].items()):
+        print(f"  {cell}: {count}")
+    print(f"{len(summary['schemas'])} distinct data file schema(s)")
+    for PID, problems in summary["problems"].items():
+        print(f"PID {PID}: {'; '.join(problems)}")
+    if summary["problems"] or len(summary["schemas"]) != 1:
+        sys.exit(1)
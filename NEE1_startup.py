@@ -0,0 +1,80 @@
+# Startup pipeline for NEE1
+# The experimenter takes a few seconds to type the participant ID, so PsychoPy is imported and the stimulus images
+# are decoded on a background thread in the meantime. The window and the stimuli themselves are still created on the
+# main thread after the prompt, because the OpenGL context belongs to the thread that opened the window.
+import importlib
+import threading
+
+import NEE1_timing
+
+
+# Imports modules and decodes images in the background; wait() blocks until both are done and re-raises any error.
+# On a virtual clock (simulation) everything is loaded straight away on the calling thread.
+class AssetPreloader:
+    def __init__(self, modules, images, clock=None):
+        self.module_names = list(modules)
+        self.image_paths = dict(images) # name: path
+        self.clock = clock or NEE1_timing.default_clock
+        self.modules = {}
+        self.images = {}
+        self.durations = {"import": None, "decode": None, "wait": None}
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        if self.clock.realtime:
+            self.thread = threading.Thread(target=self._run, name="NEE1 preload", daemon=True)
+            self.thread.start()
+        else:
+            self._run()
+        return self
+
+    def wait(self):
+        start = self.clock.now()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.durations["wait"] = self.clock.now() - start
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        try:
+            start = self.clock.now()
+            for name in self.module_names:
+                self.modules[name] = importlib.import_module(name)
+            self.durations["import"] = self.clock.now() - start
+
+            # psychopy's ImageStim takes a PIL image, so the file is read and decoded here rather than when the stimulus is made
+            start = self.clock.now()
+            if self.image_paths:
+                from PIL import Image
+            for name, path in self.image_paths.items():
+                image = Image.open(path)
+                image.load()
+                self.images[name] = image
+            self.durations["decode"] = self.clock.now() - start
+        except BaseException as error: # raised on the main thread by wait()
+            self.error = error
+
+
+# Time from launch to each named startup step, e.g. "PID", "window", "stimuli" and "first_frame"
+class StartupTimer:
+    def __init__(self, clock=None):
+        self.clock = clock or NEE1_timing.default_clock
+        self.start = self.clock.now()
+        self.marks = {}
+
+    def mark(self, name):
+        self.marks[name] = self.clock.now() - self.start
+
+    def since(self, start, end):
+        return self.marks[end] - self.marks[start]
+
+    def report(self, preloader=None):
+        report = {name + "_time": value for name, value in self.marks.items()}
+        if "PID" in self.marks and "first_frame" in self.marks:
+            report["PID_to_first_frame"] = self.since("PID", "first_frame")
+        if preloader != None:
+            report.update({"preload_" + name: value for name, value in preloader.durations.items()})
+        return report
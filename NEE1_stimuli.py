@@ -0,0 +1,40 @@
+# Stimulus helpers for NEE1
+from collections import OrderedDict
+
+
+# Keyed cache of text stimuli, so each screen text is laid out and uploaded once instead of on every call.
+# Stimuli are keyed by text, height, position, wrap width and colour; the least recently used one is dropped past max_size.
+class TextStimCache:
+    def __init__(self, win, factory, max_size=64):
+        self.win = win
+        self.factory = factory # visual.TextStim
+        self.max_size = max_size
+        self.stims = OrderedDict()
+        self.created = 0
+
+    def get(self, text, height=35, pos=(0, 0), wrapWidth=None, color="white"):
+        key = (text, height, tuple(pos), wrapWidth, color)
+        stim = self.stims.get(key)
+        if stim is None:
+            stim = self.factory(self.win, text=text, height=height, pos=pos, wrapWidth=wrapWidth, color=color)
+            self.created += 1
+            self.stims[key] = stim
+            if len(self.stims) > self.max_size:
+                self.stims.popitem(last=False)
+        else:
+            self.stims.move_to_end(key)
+        return stim
+
+    def draw(self, text, **style):
+        self.get(text, **style).draw()
+
+    # Build and draw every (text, style) pair once into the back buffer, then clear it, so glyphs and textures
+    # are ready before the first screen that needs them
+    def warm(self, texts):
+        for text, style in texts:
+            self.get(text, **style).draw()
+        self.win.clearBuffer()
+
+    def __len__(self):
+        return len(self.stims)
+
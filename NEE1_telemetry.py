@@ -0,0 +1,145 @@
+# Live telemetry for the experimenter console
+# The experiment publishes events (trial starts, choices, ratings, shocks, saved trials, port writes) as it runs, and
+# the experimenter watches them in another terminal (python NEE1_telemetry.py view) without interrupting the session.
+# publish() only appends a tuple to a bounded deque. deque.append and popleft are atomic in CPython, so the render
+# loop and the TENS pulse thread publish without taking a lock, and nothing they do can wait on the network. A
+# background thread drains the deque every ship_interval, encodes the events as JSON lines and sends them as UDP
+# datagrams to the viewer's port. UDP is connectionless: with no viewer listening, the datagrams are simply dropped.
+# If the shipper falls behind, the oldest events are dropped too. Events are numbered, so the viewer can count the gaps.
+import itertools
+import json
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+import NEE1_timing
+from NEE1_timing import TimingStats
+
+datagram_size = 8192 # events are packed into datagrams of up to this many bytes
+
+
+class TelemetryPublisher:
+    def __init__(self, address, capacity=4096, ship_interval=0.05, clock=None):
+        host, _, port = address.rpartition(":")
+        self.address = (host or "127.0.0.1", int(port))
+        self.events = deque(maxlen=capacity) # (time, number, kind, fields)
+        self.numbers = itertools.count() # next() on a count is atomic, like the deque operations
+        self.ship_interval = ship_interval
+        self.clock = clock or NEE1_timing.default_clock
+        self.sent = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="NEE1 telemetry", daemon=True)
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.thread.start()
+        return self
+
+    # Called from the render loop and the pulse thread; fields must be JSON-serialisable
+    def publish(self, kind, **fields):
+        self.events.append((self.clock.now(), next(self.numbers), kind, fields))
+
+    # Port bytes as they are written (PortState listener)
+    def port_listener(self, value):
+        self.publish("port", value=value)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join(timeout=1)
+        self.socket.close()
+
+    def _run(self):
+        while not self.stopped.wait(self.ship_interval):
+            self.ship()
+        self.ship()
+
+    def ship(self):
+        packet = b""
+        while self.events:
+            event_time, number, kind, fields = self.events.popleft()
+            line = (json.dumps({"time": event_time, "number": number, "kind": kind, **fields}) + "\n").encode("utf-8")
+            if packet and len(packet) + len(line) > datagram_size:
+                self._send(packet)
+                packet = b""
+            packet += line
+        if packet:
+            self._send(packet)
+
+    def _send(self, packet):
+        try:
+            self.socket.sendto(packet, self.address)
+            self.sent += 1
+        except OSError: # no viewer (ICMP port unreachable) or the socket buffer is full
+            pass
+
+
+# Cost of publish() as called from the render loop, with the shipper running; returns a TimingStats summary
+def measure_overhead(address, frames=20000, events_per_frame=2):
+    publisher = TelemetryPublisher(address).start()
+    trial = {"trialnum": 12, "phase": "acquisition", "trialtype": "bipolar", "choice_response": "bipolar",
+             "outcome": "medium", "exp_response": 55.0, "pain_response": 41.5}
+    cost = TimingStats()
+    for frame in range(frames):
+        start = time.perf_counter()
+        for _ in range(events_per_frame):
+            publisher.publish("trial", **trial)
+        cost.add(time.perf_counter() - start)
+        if frame % 100 == 0:
+            time.sleep(0.001) # let the shipper run, as it would between frames
+    publisher.close()
+    return cost.summary()
+
+
+# Prints the events arriving on a port; port writes are counted per trial rather than printed
+def view(address):
+    host, _, port = address.rpartition(":")
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind((host or "127.0.0.1", int(port)))
+    print(f"listening on {host or '127.0.0.1'}:{port}")
+    expected = None
+    dropped = 0
+    port_writes = 0
+    while True:
+        packet, _ = receiver.recvfrom(65536)
+        for line in packet.decode("utf-8").splitlines():
+            event = json.loads(line)
+            if expected != None and event["number"] > expected:
+                dropped += event["number"] - expected
+                print(f"  ... {event['number'] - expected} events dropped ({dropped} in total)")
+            elif expected != None and event["number"] < expected: # numbering restarted: a new session
+                dropped = 0
+            expected = event["number"] + 1
+            kind = event.pop("kind")
+            event_time = event.pop("time")
+            event.pop("number")
+            if kind == "port":
+                port_writes += 1
+                continue
+            if kind == "trial":
+                fields = ", ".join(f"{name} {event.get(name)}" for name in
+                                   ("phase", "trialtype", "choice_response", "outcome", "exp_response", "pain_response"))
+                print(f"{event_time:9.2f}  trial {event.get('trialnum', 'calibration')} saved: {fields} ({port_writes} port writes)")
+                port_writes = 0
+            else:
+                print(f"{event_time:9.2f}  {kind}: {', '.join(f'{name} {value}' for name, value in event.items())}")
+
+
+# python NEE1_telemetry.py view [host:port]      -> experimenter console (NEE1.py telemetry_address)
+# python NEE1_telemetry.py overhead [host:port]  -> cost of publishing per frame, with or without a viewer
+if __name__ == "__main__":
+    mode = sys.argv[1]
+    address = sys.argv[2] if len(sys.argv) > 2 else "127.0.0.1:8766"
+
+    if mode == "view":
+        try:
+            view(address)
+        except KeyboardInterrupt:
+            pass
+
+    elif mode == "overhead":
+        summary = measure_overhead(address)
+        print(f"publish() cost per frame (2 events): p50 {summary['p50'] * 1e6:.1f} us, p99 {summary['p99'] * 1e6:.1f} us, "
+              f"max {summary['max'] * 1e6:.1f} us")
@@ -0,0 +1,322 @@
+# Timing helpers for NEE1 (clocks, waiting, TENS pulse scheduling, frame timing)
+# Kept free of psychopy imports so the timing code can be checked without a window or parallel port.
+import csv
+import math
+import sys
+import threading
+import time
+from array import array
+
+
+# Clock used by everything in this module. realtime clocks can be slept on by background threads.
+class MonotonicClock:
+    realtime = True
+
+    def now(self):
+        return time.perf_counter()
+
+    def sleep(self, secs):
+        if secs > 0:
+            time.sleep(secs)
+
+
+# Simulated time for headless runs: sleeping jumps the clock forward instead of waiting
+class VirtualClock:
+    realtime = False
+
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def sleep(self, secs):
+        if secs > 0:
+            self.time += secs
+
+    def advance(self, secs):
+        self.sleep(secs)
+        return self.time
+
+
+default_clock = MonotonicClock()
+
+
+# Wait until deadline without burning a core: sleep in slices, calling check() at most every check_interval seconds,
+# then spin for the last spin_time seconds where the OS sleep would overshoot. Returns how late it woke up.
+def sleep_until(deadline, spin_time=0.002, check=None, check_interval=0.02, clock=None):
+    clock = clock or default_clock
+    if not clock.realtime: # nothing to gain from spinning on simulated time
+        spin_time = 0
+    next_check = clock.now()
+    while True:
+        now = clock.now()
+        if check is not None and now >= next_check:
+            check()
+            next_check = now + check_interval
+        remaining = deadline - now
+        if remaining <= spin_time:
+            break
+        if check is not None:
+            clock.sleep(min(remaining - spin_time, next_check - now))
+        else:
+            clock.sleep(remaining - spin_time)
+    while clock.now() < deadline:
+        pass
+    return clock.now() - deadline
+
+
+# Collects timing samples in seconds (wake-up overshoot, edge lateness, call latency) and summarises them
+class TimingStats:
+    def __init__(self, samples=None):
+        self.samples = samples if samples is not None else []
+
+    def add(self, overshoot):
+        self.samples.append(overshoot)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {"n": 0}
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+        return {"n": len(samples),
+                "mean": sum(samples) / len(samples),
+                "p50": percentile(50),
+                "p95": percentile(95),
+                "p99": percentile(99),
+                "max": samples[-1]}
+
+
+# Wake-up overshoot of sleep_until for each candidate spin_time, used to pick wait_spin_time for a machine
+def measure_overshoot(spin_times=(0, 0.0005, 0.001, 0.002, 0.005), duration=0.01, repeats=100, clock=None):
+    clock = clock or default_clock
+    results = {}
+    for spin_time in spin_times:
+        stats = TimingStats()
+        cpu_start = time.process_time()
+        for _ in range(repeats):
+            stats.add(sleep_until(clock.now() + duration, spin_time=spin_time, clock=clock))
+        results[spin_time] = dict(stats.summary(), cpu_fraction=(time.process_time() - cpu_start) / (duration * repeats))
+    return results
+
+
+# Compile a TENS pulse pattern into an absolute edge timeline.
+# pattern is a list of (offset in seconds, port value) pairs within one period (see TENS_pulse_pattern_list in NEE1.py),
+# repeated every period seconds for as long as TENS is on.
+class PulseTimeline:
+    def __init__(self, pattern, duration, period=1.0):
+        edges = []
+        for cycle in range(int(math.ceil(duration / period))):
+            for offset, value in pattern:
+                edge_time = cycle * period + offset
+                if edge_time < duration:
+                    edges.append((edge_time, value))
+        edges.sort(key=lambda edge: edge[0])
+
+        self.offsets = [edge_time for edge_time, value in edges]
+        self.values = [value for edge_time, value in edges]
+        self.fired = [None] * len(edges) # time each edge was actually sent
+        self.next_edge = 0
+        self.start = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def arm(self, start):
+        self.start = start
+        self.next_edge = 0
+        self.fired = [None] * len(self.offsets)
+
+    def finished(self):
+        return self.next_edge >= len(self.offsets)
+
+    def next_deadline(self):
+        return self.start + self.offsets[self.next_edge]
+
+    # Send every edge whose deadline has passed, each exactly once
+    def fire_due(self, now, write, clock=default_clock):
+        while self.next_edge < len(self.offsets) and self.start + self.offsets[self.next_edge] <= now:
+            write(self.values[self.next_edge])
+            self.fired[self.next_edge] = clock.now()
+            self.next_edge += 1
+
+    # Lateness of each fired edge in seconds (None if it never fired)
+    def jitter(self):
+        return [None if fired is None else fired - (self.start + offset)
+                for offset, fired in zip(self.offsets, self.fired)]
+
+    # Achieved time from each fired edge with start_value to the next fired edge with end_value, e.g. periods of a
+    # square wave with intervals(128, 128) and its on-times with intervals(128, 0)
+    def intervals(self, start_value, end_value):
+        fired = [(fired, value) for fired, value in zip(self.fired, self.values) if fired is not None]
+        intervals = []
+        for i, (start, value) in enumerate(fired):
+            if value != start_value:
+                continue
+            for end, next_value in fired[i + 1:]:
+                if next_value == end_value:
+                    intervals.append(end - start)
+                    break
+        return intervals
+
+    def jitter_report(self, budget):
+        jitter = [j for j in self.jitter() if j is not None]
+        return {"edges": len(self.offsets),
+                "fired": len(jitter),
+                "jitter_mean": sum(jitter) / len(jitter) if jitter else None,
+                "jitter_max": max(jitter) if jitter else None,
+                "within_budget": len(jitter) == len(self.offsets) and all(j <= budget for j in jitter)}
+
+
+# One period of a square wave as a pulse pattern: value for the first duty_cycle of every 1 / frequency seconds, then 0.
+# Returns (pattern, period) for PulseTimeline.
+def square_wave(frequency, duty_cycle=0.5, value=128):
+    if frequency <= 0 or not 0 < duty_cycle < 1:
+        raise ValueError(f"need frequency > 0 and 0 < duty cycle < 1, got {frequency} Hz and {duty_cycle}")
+    period = 1 / frequency
+    return [(0.0, value), (duty_cycle * period, 0)], period
+
+
+# Fire a PulseTimeline against its absolute deadlines.
+# With a realtime clock a background thread sleeps until just before each edge and spins for the last spin_time seconds,
+# so edges do not depend on the frame rate of the render loop. Otherwise poll() has to be called every frame.
+# The interpreter switch interval is shortened while the thread runs so the render loop cannot hold the GIL past a deadline.
+class PulseEngine:
+    def __init__(self, timeline, write, clock=None, spin_time=0.002, switch_interval=0.0005):
+        self.timeline = timeline
+        self.write = write
+        self.clock = clock or default_clock
+        self.spin_time = spin_time
+        self.switch_interval = switch_interval
+        self.previous_switch_interval = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self, at=None):
+        self.timeline.arm(self.clock.now() if at is None else at)
+        if self.clock.realtime:
+            self.previous_switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(self.switch_interval)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def poll(self):
+        if self.thread is None and self.timeline.start is not None:
+            self.timeline.fire_due(self.clock.now(), self.write, self.clock)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            sys.setswitchinterval(self.previous_switch_interval)
+
+    def _run(self):
+        timeline = self.timeline
+        while not self.stop_event.is_set() and not timeline.finished():
+            deadline = timeline.next_deadline()
+            remaining = deadline - self.clock.now()
+            if remaining > self.spin_time:
+                self.stop_event.wait(remaining - self.spin_time)
+                continue
+            while self.clock.now() < deadline:
+                pass
+            timeline.fire_due(self.clock.now(), self.write, self.clock)
+
+
+# Records win.flip() timestamps per trial phase into preallocated arrays, so recording a flip is a few array stores.
+# Flips past capacity are counted but not kept.
+class FlipRecorder:
+    phases = {"pre_TENS": 0, "TENS_on": 1, "expectancy": 2, "shock": 3, "rating": 4}
+
+    def __init__(self, capacity=200000):
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.phase_codes = array("B", bytes(capacity))
+        self.trials = array("l", bytes(array("l").itemsize * capacity))
+        self.count = 0
+        self.overflow = 0
+        self.trial = 0
+
+    def begin_trial(self, trialnum):
+        self.trial = trialnum
+
+    def record(self, flip_time, phase):
+        if self.count < self.capacity:
+            self.times[self.count] = flip_time
+            self.phase_codes[self.count] = self.phases[phase]
+            self.trials[self.count] = self.trial
+            self.count += 1
+        else:
+            self.overflow += 1
+
+    # Frame intervals (seconds) per (trial, phase). Only consecutive flips of the same trial and phase are paired,
+    # so deliberate pauses between phases (e.g. the shock buffer) are not counted as dropped frames.
+    def intervals(self):
+        intervals = {}
+        for i in range(self.count):
+            phase_intervals = intervals.setdefault((self.trials[i], self.phase_codes[i]), [])
+            if i > 0 and self.trials[i] == self.trials[i - 1] and self.phase_codes[i] == self.phase_codes[i - 1]:
+                phase_intervals.append(self.times[i] - self.times[i - 1])
+        return intervals
+
+    # One row per trial and phase: frame interval percentiles and frames that took more than 1.5 refresh periods
+    def summary(self, frame_period):
+        phase_names = {code: name for name, code in self.phases.items()}
+        rows = []
+        for (trial, phase_code), phase_intervals in sorted(self.intervals().items()):
+            summary = TimingStats(phase_intervals).summary()
+            row = {"trialnum": trial,
+                   "phase": phase_names[phase_code],
+                   "frames": len(phase_intervals) + 1,
+                   "dropped_frames": sum(1 for interval in phase_intervals if interval > 1.5 * frame_period)}
+            for percentile in ("p50", "p95", "p99", "max"):
+                row[f"interval_{percentile}_ms"] = summary[percentile] * 1000 if phase_intervals else None
+            rows.append(row)
+        return rows
+
+    def write_summary(self, path, frame_period):
+        rows = self.summary(frame_period)
+        with open(path, mode="w", newline="") as summary_file:
+            writer = csv.DictWriter(summary_file, fieldnames=["trialnum", "phase", "frames", "dropped_frames",
+                                                              "interval_p50_ms", "interval_p95_ms", "interval_p99_ms",
+                                                              "interval_max_ms"])
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+# python NEE1_timing.py overshoot          -> wake-up overshoot for a range of spin times
+# python NEE1_timing.py jitter [threads]   -> run a pulse pattern against a dummy port under CPU load, print per-edge jitter
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "overshoot"
+
+    if mode == "overshoot":
+        for spin_time, summary in measure_overshoot().items():
+            print(f"spin {spin_time * 1000:4.1f} ms: mean {summary['mean'] * 1000:6.3f} ms, "
+                  f"p99 {summary['p99'] * 1000:6.3f} ms, max {summary['max'] * 1000:6.3f} ms, "
+                  f"cpu {summary['cpu_fraction'] * 100:5.1f}%")
+
+    elif mode == "jitter":
+        pattern = [(0.0, 128), (0.1, 0), (0.2, 128), (0.3, 0), (0.4, 128), (0.5, 0)]
+        load_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+        budget = 0.01
+
+        stop_load = threading.Event()
+        def load():
+            while not stop_load.is_set():
+                sum(i * i for i in range(1000))
+        for _ in range(load_threads):
+            threading.Thread(target=load, daemon=True).start()
+
+        timeline = PulseTimeline(pattern, duration=3)
+        engine = PulseEngine(timeline, lambda value: None)
+        engine.start()
+        while not timeline.finished():
+            time.sleep(0.05)
+        engine.stop()
+        stop_load.set()
+
+        for offset, value, lateness in zip(timeline.offsets, timeline.values, timeline.jitter()):
+            print(f"{offset:6.3f}s  {value:3d}  {lateness * 1000:7.3f} ms")
+        print(timeline.jitter_report(budget))
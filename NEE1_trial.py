@@ -0,0 +1,63 @@
+# Frame-locked trial phases for NEE1
+# A trial is a list of TrialPhase objects that run_phases() steps through once per flip. Fixed-length phases end on
+# frame counts worked out from the refresh rate before they start, counted from the last open-ended phase so rounding
+# never adds up, and the flip timestamp (the one clock read per frame) gives the frame number, so a dropped frame
+# does not stretch the trial and a boundary is never found a frame late by re-reading a timer.
+from bisect import bisect_right
+
+
+class TrialPhase:
+    def __init__(self, name, duration=None, stims=(), draw=None, enter=None, exit=None, done=None):
+        self.name = name # passed to flip() (see FlipRecorder.phases)
+        self.duration = duration # seconds, or None to run until done() is True
+        self.stims = list(stims) # drawn every frame
+        self.draw = draw # draw(frame) for stimuli that change, frame counted from the first flip of the run
+        self.enter = enter # called before the first frame of the phase is drawn
+        self.exit = exit # called after its last frame
+        self.done = done # checked after every flip of the phase
+
+
+def frames(seconds, frame_period):
+    return int(round(seconds / frame_period))
+
+
+# Number to show on each frame of a countdown from seconds down to 1, switching on whole-second frame counts
+def countdown_numbers(seconds, frame_period):
+    boundaries = [frames(second, frame_period) for second in range(1, seconds + 1)]
+    return [seconds - bisect_right(boundaries, frame) for frame in range(boundaries[-1])]
+
+
+# Run phases in order, one flip(name) per frame; flip returns the time the frame was shown. check() (e.g. the escape
+# key) is called once per frame. Returns the number of frames the run took.
+def run_phases(phases, flip, frame_period, check=None):
+    onset = None
+    frame = 0 # frames since the first flip of the run
+    base_frame = 0 # fixed-length phases are timed from here (the start of the run or the end of an open-ended phase)
+    base_time = 0.0 # length of the fixed-length phases since base_frame
+    for phase in phases:
+        if phase.enter is not None:
+            phase.enter()
+        end_frame = None
+        if phase.duration is not None:
+            base_time += phase.duration
+            end_frame = base_frame + frames(base_time, frame_period)
+
+        while end_frame is None or frame < end_frame:
+            if check is not None:
+                check()
+            for stim in phase.stims:
+                stim.draw()
+            if phase.draw is not None:
+                phase.draw(frame)
+            flip_time = flip(phase.name)
+            if onset is None:
+                onset = flip_time
+            frame = frames(flip_time - onset, frame_period) + 1
+            if phase.done is not None and phase.done():
+                break
+
+        if phase.exit is not None:
+            phase.exit()
+        if phase.duration is None:
+            base_frame, base_time = frame, 0.0
+    return frame
@@ -0,0 +1,299 @@
+# Watchdogs for NEE1
+# EscapeWatcher polls the escape key on its own thread every poll_interval, independent of what the main thread is
+# doing (drawing, waiting for a click, sleeping through the ITI). On Windows the key is read with windows_key_down,
+# only while the experiment window has focus; elsewhere it comes from the response keyboard (ResponseEngine.escape_down
+# in NEE1_input.py, which shares the keyboard safely with the main thread). When escape goes down the watcher zeroes
+# the port itself
+# (on_escape, e.g. PortState.shutdown) and raises a flag. The main thread then only checks that flag
+# (termination_check) to save and exit. The port is off within one poll interval plus a port write of the key going
+# down. The watcher measures both parts, and how long the main thread took to notice.
+# On a virtual clock (simulation), or with a key source that can't be read off the main thread, nothing runs in the
+# background and the key is polled each time the flag is checked.
+# StallWatchdog checks every poll_interval that no port field has been on for longer than its maximum on-time. It also
+# checks that the main loop is still beating while anything is on. If either check fails it clears the port, latches
+# fields low (PortState.latch) and logs an incident. A field left on too long stays latched until the main loop clears
+# the port (at the next trial); after a stall every field stays latched until the main loop beats again. Either way a
+# TENS pulse thread that is still running can't switch the port back on, and one stall is one incident. The main
+# loop's part is beat() (one float stored) and a PortState listener (a few comparisons per write).
+# Both watchers are threads, so a stall that holds the GIL (a long garbage collection) holds them up too. Stalls in
+# drivers, the OS or window events do not hold it.
+import csv
+import os
+import sys
+import threading
+import time
+
+import NEE1_timing
+
+
+# Escape key sources: functions returning True while the key is down
+# GetAsyncKeyState reads the key from any thread whatever window has focus, so escape only counts while the experiment
+# window (window_handle) is in the foreground: an escape pressed in the telemetry viewer or a console is ignored
+def windows_key_down(window_handle, virtual_key=0x1B): # VK_ESCAPE
+    import ctypes
+    user32 = ctypes.windll.user32
+    user32.GetForegroundWindow.restype = ctypes.c_void_p
+    get_key_state = user32.GetAsyncKeyState
+    return lambda: bool(get_key_state(virtual_key) & 0x8000) and user32.GetForegroundWindow() == window_handle
+
+
+# Native handle of a psychopy window (pyglet backend), or None
+def window_handle(win):
+    return getattr(getattr(win, "winHandle", None), "_hwnd", None)
+
+
+class EscapeWatcher:
+    def __init__(self, key_down, on_escape, threaded=True, poll_interval=0.001, source=None, clock=None):
+        self.key_down = key_down
+        self.source = source # name of the key source, reported with the latencies it gives
+        self.on_escape = on_escape
+        self.clock = clock or NEE1_timing.default_clock
+        self.threaded = threaded and self.clock.realtime
+        self.poll_interval = poll_interval
+        self.triggered = threading.Event()
+        self.stopped = threading.Event()
+        self.detected = None # when the key was seen down
+        self.zeroed = None # when on_escape returned
+        self.handled = None # when the main thread noticed
+        self.polls = 0
+        self.poll_gap_max = 0.0 # longest time between two polls, the bound on how late a press is seen
+        self.poll_gap_total = 0.0
+        self.thread = None
+
+    def start(self):
+        if self.threaded:
+            self.thread = threading.Thread(target=self._run, name="NEE1 escape watcher", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    # True once escape has been pressed (cheap enough to call every frame)
+    def pending(self):
+        if not self.threaded and not self.triggered.is_set() and self.key_down():
+            self._trigger(self.clock.now())
+        return self.triggered.is_set()
+
+    # Called by the main thread when it starts the exit
+    def handle(self):
+        if self.handled is None:
+            self.handled = self.clock.now()
+
+    def _run(self):
+        last = self.clock.now()
+        while not self.stopped.is_set():
+            now = self.clock.now()
+            gap = now - last
+            last = now
+            self.polls += 1
+            self.poll_gap_total += gap
+            if gap > self.poll_gap_max:
+                self.poll_gap_max = gap
+            if self.key_down():
+                self._trigger(now)
+                return
+            self.clock.sleep(self.poll_interval)
+
+    def _trigger(self, detected):
+        self.detected = detected
+        self.on_escape()
+        self.zeroed = self.clock.now()
+        self.triggered.set()
+
+    def report(self):
+        report = {"source": self.source,
+                  "threaded": self.threaded,
+                  "poll_interval_max": self.poll_gap_max if self.polls > 1 else None,
+                  "poll_interval_mean": self.poll_gap_total / (self.polls - 1) if self.polls > 1 else None,
+                  "detect_to_zero": None,
+                  "detect_to_exit": None}
+        if self.detected is not None:
+            report["detect_to_zero"] = self.zeroed - self.detected
+            if self.handled is not None:
+                report["detect_to_exit"] = self.handled - self.detected
+        return report
+
+
+class StallWatchdog:
+    def __init__(self, port_state, max_on_time, heartbeat_timeout=0.25, poll_interval=0.002, incident_path=None, clock=None):
+        self.port_state = port_state
+        self.max_on_time = dict(max_on_time) # field name: seconds it may stay on
+        self.masks = {name: port_state.fields[name] for name in self.max_on_time}
+        self.heartbeat_timeout = heartbeat_timeout # longest the main loop may go without beat() while the port is on
+        self.poll_interval = poll_interval
+        self.incident_path = incident_path # incidents are appended here as CSV rows
+        self.clock = clock or NEE1_timing.default_clock
+        self.threaded = self.clock.realtime
+        self.last_beat = self.clock.now()
+        self.value = port_state.value
+        self.on_since = {name: None for name in self.masks} # when each field was last switched on
+        self.incidents = []
+        self.stall_latched = None # fields latched by a stall, released by the next beat()
+        self.stopped = threading.Event()
+        self.thread = None
+        port_state.listeners.append(self.port_written)
+
+    def start(self):
+        if self.threaded:
+            self.thread = threading.Thread(target=self._run, name="NEE1 stall watchdog", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    # Main loop heartbeat (on a virtual clock this is also where the check runs)
+    def beat(self):
+        self.last_beat = self.clock.now()
+        if self.stall_latched is not None:
+            names, self.stall_latched = self.stall_latched, None
+            self.port_state.release(names)
+        if not self.threaded:
+            self.check(self.last_beat)
+
+    # PortState listener (called under the port lock, from whichever thread wrote)
+    def port_written(self, value):
+        now = self.clock.now()
+        for name, mask in self.masks.items():
+            if not value & mask:
+                self.on_since[name] = None
+            elif self.on_since[name] is None:
+                self.on_since[name] = now
+        self.value = value
+
+    def check(self, now):
+        if not self.value:
+            return
+        for name, since in self.on_since.items():
+            if since is not None and now - since > self.max_on_time[name]:
+                self.trip(now, f"{name} on for longer than {self.max_on_time[name]} s", [name])
+                return
+        if now - self.last_beat > self.heartbeat_timeout:
+            names = list(self.port_state.fields)
+            self.trip(now, f"main loop stalled for longer than {self.heartbeat_timeout} s", names)
+            self.stall_latched = names
+
+    # Clear the port, hold the fields named low and log the incident
+    def trip(self, now, reason, names):
+        value = self.value
+        on_times = {name: None if since is None else now - since for name, since in self.on_since.items()}
+        self.port_state.latch(names)
+        incident = {"time": now,
+                    "cleared_after": self.clock.now() - now,
+                    "reason": reason,
+                    "value": value,
+                    "latched": " ".join(names),
+                    "heartbeat_age": now - self.last_beat}
+        incident.update({f"{name}_on_time": on_time for name, on_time in on_times.items()})
+        self.incidents.append(incident)
+        print(f"Stall watchdog cleared the port ({reason}): {incident}")
+        if self.incident_path is not None:
+            write_header = not os.path.exists(self.incident_path)
+            with open(self.incident_path, mode="a", newline="") as incident_file:
+                writer = csv.DictWriter(incident_file, fieldnames=list(incident))
+                if write_header:
+                    writer.writeheader()
+                writer.writerow(incident)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.check(self.clock.now())
+            self.clock.sleep(self.poll_interval)
+
+
+# Press-to-port-off latency: a simulated key goes down at a random moment and the time until the port reads 0 is
+# measured, repeats times (real clock, recording port). Returns a TimingStats summary and the last watcher report.
+def measure_escape_latency(repeats=50, poll_interval=0.001):
+    import random
+    from NEE1_port import PortState, RecordingPort
+    from NEE1_timing import TimingStats
+
+    clock = NEE1_timing.MonotonicClock()
+    latency = TimingStats()
+    for _ in range(repeats):
+        port = PortState(RecordingPort(clock), {"TENS": 0x80, "shock": 0x7F})
+        port.set("shock", 5)
+        pressed = []
+        watcher = EscapeWatcher(lambda: bool(pressed), port.shutdown, poll_interval=poll_interval, clock=clock).start()
+        clock.sleep(random.uniform(0.005, 0.02))
+        pressed.append(clock.now())
+        watcher.triggered.wait(1)
+        latency.add(port.port.times[-1] - pressed[0])
+        watcher.stop()
+    return latency.summary(), watcher.report()
+
+
+# A main loop that turns the shock on with TENS pulsing (a live PulseEngine) and then stalls (sleeps without beating),
+# repeats times, and the same with a field left on while the loop keeps beating and setting it. Returns summaries of
+# how long the port stayed on past each limit and of the cost of beat() per call, and how many times the port was
+# switched back on while a field was latched (0 unless latching fails, when the pulses re-arm it and it trips again).
+def measure_stalls(repeats=20, heartbeat_timeout=0.05, max_on_time=0.1):
+    import contextlib
+    import io
+    from NEE1_port import PortState, RecordingPort
+    from NEE1_timing import PulseTimeline, PulseEngine, TimingStats
+
+    clock = NEE1_timing.MonotonicClock()
+    stall_late = TimingStats()
+    on_time_late = TimingStats()
+    beat_cost = TimingStats()
+    rearmed = 0
+    pulses = [(0.0, 0x80), (0.02, 0), (0.04, 0x80), (0.06, 0)] # an edge every 20 ms
+    with contextlib.redirect_stdout(io.StringIO()): # every repeat trips twice
+        for repeat in range(repeats):
+            port = PortState(RecordingPort(clock), {"TENS": 0x80, "shock": 0x7F})
+            watchdog = StallWatchdog(port, {"TENS": max_on_time, "shock": max_on_time * 10},
+                                     heartbeat_timeout=heartbeat_timeout, clock=clock).start()
+            watchdog.beat()
+            engine = PulseEngine(PulseTimeline(pulses, heartbeat_timeout * 8, period=0.08), port.writer("TENS"), clock=clock)
+            engine.start()
+            port.set("shock", 5) # the loop stalls with the shock on and TENS pulsing
+            clock.sleep(heartbeat_timeout * 6) # several pulse edges after the trip
+            incident = watchdog.incidents[0]
+            stall_late.add(incident["heartbeat_age"] + incident["cleared_after"] - heartbeat_timeout)
+            tripped = incident["time"] + incident["cleared_after"]
+            rearmed += sum(1 for t, v in zip(port.port.times, port.port.values) if t > tripped and v)
+            rearmed += len(watchdog.incidents) - 1
+            engine.stop()
+
+            watchdog.beat() # the loop is back: the stall latch is released
+            port.clear()
+            trips = len(watchdog.incidents)
+            port.set("TENS", 1) # TENS left on while the loop keeps beating (and keeps setting it)
+            switched_on = clock.now()
+            while clock.now() - switched_on < max_on_time * 3:
+                start = time.perf_counter()
+                watchdog.beat()
+                beat_cost.add(time.perf_counter() - start)
+                port.set("TENS", 1)
+                clock.sleep(0.005)
+            incident = watchdog.incidents[trips]
+            on_time_late.add(incident["TENS_on_time"] + incident["cleared_after"] - max_on_time)
+            tripped = incident["time"] + incident["cleared_after"]
+            rearmed += sum(1 for t, v in zip(port.port.times, port.port.values) if t > tripped and v)
+            rearmed += len(watchdog.incidents) - trips - 1
+            watchdog.stop()
+    return stall_late.summary(), on_time_late.summary(), beat_cost.summary(), rearmed
+
+
+# python NEE1_watchdog.py escape [repeats]  -> time from escape going down to the port reading 0
+# python NEE1_watchdog.py stall [repeats]   -> how long the port stays on past the heartbeat and on-time limits
+if __name__ == "__main__":
+    mode = sys.argv[1]
+
+    if mode == "escape":
+        summary, report = measure_escape_latency(int(sys.argv[2]) if len(sys.argv) > 2 else 50)
+        print(f"escape to port off: p50 {summary['p50'] * 1000:.2f} ms, p99 {summary['p99'] * 1000:.2f} ms, "
+              f"max {summary['max'] * 1000:.2f} ms (poll interval max {report['poll_interval_max'] * 1000:.2f} ms)")
+
+    elif mode == "stall":
+        stall_late, on_time_late, beat_cost, rearmed = measure_stalls(int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+        print(f"port cleared after a stall: p50 {stall_late['p50'] * 1000:.2f} ms, max {stall_late['max'] * 1000:.2f} ms past the heartbeat timeout")
+        print(f"port cleared after a field stayed on: p50 {on_time_late['p50'] * 1000:.2f} ms, max {on_time_late['max'] * 1000:.2f} ms past its on-time")
+        print(f"beat() cost: p50 {beat_cost['p50'] * 1e6:.2f} us, p99 {beat_cost['p99'] * 1e6:.2f} us")
+        print(f"port switched back on while latched: {rearmed} times")